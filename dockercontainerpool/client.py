@@ -0,0 +1,252 @@
+import json
+import time
+import requests
+import threading
+
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+
+from errors import DockerContainerPoolClientException
+
+
+__doc__ = '''
+This module is a python client for the RESTlike interface of server.py.
+
+It keeps persistent connections, caches group and container state for a
+short time and coalesces concurrent identical GET requests into one.
+'''
+
+CACHE_TTL = 2.0
+POOL_SIZE = 10
+
+
+class _Call(object):
+    # a GET request other threads can wait for
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class DockerContainerPoolClient(object):
+    base_url = None
+    session = None
+    cache_ttl = CACHE_TTL
+
+    def __init__(
+            self,
+            base_url,
+            cache_ttl=CACHE_TTL,
+            pool_size=POOL_SIZE,
+            session=None):
+
+        self.base_url = base_url.rstrip('/')
+        self.cache_ttl = cache_ttl
+        self.pool_size = pool_size
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+        self._cache = {}
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    # container groups
+
+    def add_container_group(self, group_identifier, specs, **options):
+        options['specs'] = specs
+        return self._post(group_identifier, '', options)
+
+    def get_container_group(self, group_identifier):
+        return self._get(self._path(group_identifier))
+
+    def update_container_group(self, group_identifier, specs):
+        return self._request(
+            'PUT', self._path(group_identifier), dict(specs=specs),
+            group_identifier)
+
+    def delete_container_group(self, group_identifier, **options):
+        return self._request(
+            'DELETE', self._path(group_identifier), options,
+            group_identifier)
+
+    def set_running_container(self, group_identifier, count):
+        return self._post(
+            group_identifier, '/set_running_container', dict(count=count))
+
+    def set_available_container(self, group_identifier, count):
+        return self._post(
+            group_identifier, '/set_available_container', dict(count=count))
+
+    # containers
+
+    def get_container_list(self, group_identifier):
+        return self._get(self._path(group_identifier, '/container'))
+
+    def get_container(self, group_identifier, container_identifier):
+        return self._get(self._path(
+            group_identifier, '/container/' + container_identifier))
+
+    def create_container(self, group_identifier, start=True, specs=None):
+        return self._post(
+            group_identifier, '/container',
+            dict(start=start, specs=specs or {}))
+
+    def start_container(self, group_identifier, container_identifier):
+        return self._post(
+            group_identifier,
+            '/container/{}/start'.format(container_identifier))
+
+    def stop_container(self, group_identifier, container_identifier):
+        return self._post(
+            group_identifier,
+            '/container/{}/stop'.format(container_identifier))
+
+    def remove_container(self, group_identifier, container_identifier):
+        return self._request(
+            'DELETE',
+            self._path(
+                group_identifier, '/container/' + container_identifier),
+            group_identifier=group_identifier)
+
+    def exec_command_container(
+            self, group_identifier, container_identifier, command):
+        return self._post(
+            group_identifier,
+            '/container/{}/exec'.format(container_identifier),
+            dict(command=command))
+
+    def exec_command_group(
+            self,
+            group_identifier,
+            command,
+            container_identifiers=None,
+            **options):
+        # yields the result of each container, as it finishes
+        options['command'] = command
+        if container_identifiers is not None:
+            options['container'] = container_identifiers
+        response = self.session.request(
+            'POST', self.base_url + self._path(group_identifier, '/exec'),
+            data=json.dumps(options),
+            headers={'Content-Type': 'application/json'},
+            stream=True)
+        if response.status_code >= 400:
+            self._raise(response)
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
+    def acquire_container(self, group_identifier, count=1, session_key=None):
+        # one request for all `count` containers
+        data = dict(count=count)
+        if session_key is not None:
+            data['session_key'] = session_key
+        return self._post(group_identifier, '/acquire', data)
+
+    def release_container(self, group_identifier, container_identifier):
+        return self._post(
+            group_identifier,
+            '/container/{}/release'.format(container_identifier))
+
+    def batch(self, calls):
+        '''
+        Runs the calls concurrently on the shared connection pool and
+        returns their results in order. A call is a tuple
+        (method name, args[, kwargs]), e.g.
+        ('exec_command_container', ('redis', container_id, 'ls'))
+        '''
+        if not calls:
+            return []
+
+        def run(call):
+            name, args = call[0], call[1]
+            kwargs = call[2] if len(call) > 2 else {}
+            return getattr(self, name)(*args, **kwargs)
+
+        thread_pool = ThreadPool(min(self.pool_size, len(calls)))
+        try:
+            return thread_pool.map(run, calls)
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache = {}
+
+    def _path(self, group_identifier, path=''):
+        return '/container_group/{}{}'.format(group_identifier, path)
+
+    def _post(self, group_identifier, path, data=None):
+        return self._request(
+            'POST', self._path(group_identifier, path), data,
+            group_identifier)
+
+    def _get(self, path):
+        # cached for `cache_ttl` seconds, concurrent requests of the same
+        # path wait for the first one
+        with self._lock:
+            entry = self._cache.get(path)
+            if entry is not None and entry[0] > time.time():
+                return entry[1]
+            call = self._calls.get(path)
+            owner = call is None
+            if owner:
+                call = self._calls[path] = _Call()
+
+        if not owner:
+            return call.wait()
+
+        try:
+            call.result = self._request('GET', path)
+        except Exception as e:
+            call.error = e
+            raise
+        else:
+            with self._lock:
+                self._cache[path] = (
+                    time.time() + self.cache_ttl, call.result)
+            return call.result
+        finally:
+            with self._lock:
+                del self._calls[path]
+            call.event.set()
+
+    def _request(self, method, path, data=None, group_identifier=None):
+        if group_identifier is not None:
+            # the state of the group changes
+            self._invalidate(group_identifier)
+
+        response = self.session.request(
+            method, self.base_url + path,
+            data=None if data is None else json.dumps(data),
+            headers={'Content-Type': 'application/json'})
+
+        if response.status_code >= 400:
+            self._raise(response)
+        return json.loads(response.content) if response.content else None
+
+    def _raise(self, response):
+        parsed_json = json.loads(response.content) if response.content \
+            else {}
+        raise DockerContainerPoolClientException(
+            parsed_json.get('message', response.reason),
+            status_code=response.status_code,
+            error_type=parsed_json.get('error_type'))
+
+    def _invalidate(self, group_identifier):
+        path = self._path(group_identifier)
+        with self._lock:
+            for key in list(self._cache):
+                if key == path or key.startswith(path + '/'):
+                    del self._cache[key]
@@ -0,0 +1,116 @@
+import os
+import json
+import math
+import time
+import threading
+
+
+__doc__ = '''
+This module records the acquire demand per container group and forecasts
+the near-term demand with a seasonal model.
+
+The demand is counted in buckets of `bucket_seconds`. Every finished
+bucket is folded into a daily and a weekly profile (an exponentially
+weighted moving average per bucket of the day and of the week), the
+forecast of a bucket is the mean of both profiles.
+'''
+
+BUCKET_SECONDS = 300
+SMOOTHING = 0.3
+LEAD_BUCKETS = 2
+
+DAY = 24 * 60 * 60
+WEEK = 7 * DAY
+
+
+class DemandHistory(object):
+    path = None
+    profiles = None
+
+    def __init__(
+            self,
+            path=None,
+            bucket_seconds=BUCKET_SECONDS,
+            smoothing=SMOOTHING):
+
+        self.path = path
+        self.bucket_seconds = bucket_seconds
+        self.smoothing = smoothing
+        # group identifier -> dict(daily=[...], weekly=[...])
+        self.profiles = {}
+        # group identifier -> [bucket, count] of the running bucket
+        self.current = {}
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            self.load()
+
+    @property
+    def daily_buckets(self):
+        return DAY // self.bucket_seconds
+
+    @property
+    def weekly_buckets(self):
+        return WEEK // self.bucket_seconds
+
+    def record(self, group_identifier, count=1, now=None):
+        with self._lock:
+            self._roll(group_identifier, now)[1] += count
+
+    def forecast(self, group_identifier, lead=LEAD_BUCKETS, now=None):
+        # the highest expected demand of the next `lead` buckets
+        with self._lock:
+            bucket = self._roll(group_identifier, now)[0]
+            profile = self.profiles.get(group_identifier)
+            if profile is None:
+                return 0
+            return int(math.ceil(max(
+                (profile['daily'][b % self.daily_buckets] +
+                 profile['weekly'][b % self.weekly_buckets]) / 2.0
+                for b in range(bucket + 1, bucket + 1 + lead))))
+
+    def load(self):
+        with open(self.path) as f:
+            stored = json.load(f)
+        if stored.get('bucket_seconds') == self.bucket_seconds:
+            self.profiles = stored['profiles']
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(dict(
+                bucket_seconds=self.bucket_seconds, profiles=self.profiles))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, self.path)
+
+    def _roll(self, group_identifier, now=None):
+        # folds the finished buckets into the profiles and returns the
+        # running bucket
+        bucket = int((now or time.time()) // self.bucket_seconds)
+        current = self.current.get(group_identifier)
+        if current is None:
+            current = self.current[group_identifier] = [bucket, 0]
+        elif current[0] != bucket:
+            self._fold(group_identifier, current[0], current[1])
+            # buckets without any demand, at most one week
+            for b in range(current[0] + 1,
+                           min(bucket, current[0] + self.weekly_buckets)):
+                self._fold(group_identifier, b, 0)
+            current = self.current[group_identifier] = [bucket, 0]
+        return current
+
+    def _fold(self, group_identifier, bucket, count):
+        profile = self.profiles.get(group_identifier)
+        if profile is None:
+            profile = self.profiles[group_identifier] = dict(
+                daily=[0.0] * self.daily_buckets,
+                weekly=[0.0] * self.weekly_buckets)
+        for name, size in (('daily', self.daily_buckets),
+                           ('weekly', self.weekly_buckets)):
+            values = profile[name]
+            i = bucket % size
+            values[i] = round(
+                (1 - self.smoothing) * values[i] + self.smoothing * count, 3)
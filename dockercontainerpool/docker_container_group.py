@@ -1,10 +1,28 @@
+import os
+import re
 import sys
+import json
+import time
 import uuid
 import docker
+import select
+import struct
+import hashlib
 import logging
+import threading
 
 from copy import deepcopy
 from docker.errors import APIError
+from multiprocessing.pool import ThreadPool
+
+from errors import (
+    DockerContainerGroupException,
+    DockerContainerGroupDraining,
+    DockerContainerGroupContainerNotFound,
+    DockerContainerGroupSlotNotFound,
+    DockerContainerGroupInvalidCount
+)
+from journal import Journal, journaled
 
 
 __doc__ = '''
@@ -16,32 +34,203 @@ handler = logging.StreamHandler(stream=sys.stdout)
 handler.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
+LABEL_GROUP = 'dockercontainerpool.group'
+LABEL_REVISION = 'dockercontainerpool.revision'
+LABEL_STATE = 'dockercontainerpool.state'
+LABEL_OPERATION = 'dockercontainerpool.operation'
+LABEL_SLOT = 'dockercontainerpool.slot'
+
+TEARDOWN_WORKERS = 10
+STOP_TIMEOUT = 10
+
+AFFINITY_TTL = 600
+
+EXEC_WORKERS = 10
+
+SNAPSHOT_REPOSITORY = 'dockercontainerpool-snapshot/{}'
+SNAPSHOT_STATE = 'snapshot'
+SNAPSHOT_TIMEOUT = 120
+SNAPSHOT_INTERVAL = 1
+SNAPSHOT_RETRY = 600
+
 
 class DockerContainerGroup(object):
     group_identifier = None
     client = None
+    journal = None
     specs = {}
+    label_index = None
+    leased = None
+    affinity = None
+    affinity_ttl = AFFINITY_TTL
+    draining = False
+    min_count = 0
+    max_count = None
+    snapshot = None
+    snapshot_image = None
+    snapshot_revision = None
+    snapshot_failure = None
+    slots = None
+    slot_list = None
 
     def __init__(
             self,
             group_identifier,
             client,
             specs,
-            update_image=False):
+            update_image=False,
+            snapshot=None,
+            min_count=0,
+            max_count=None,
+            affinity_ttl=AFFINITY_TTL,
+            slots=None):
 
         self.group_identifier = group_identifier
         self.client = client
+        self.journal = Journal()
         self.specs = specs
+        self.min_count = min_count
+        self.max_count = max_count
+        self.snapshot = snapshot
+        # maps 'label=value' to the set of container ids carrying it
+        self.label_index = {}
+        # ids of the containers handed out by `acquire_container`
+        self.leased = set()
+        # session key -> [container, expiry time]
+        self.affinity = {}
+        self.affinity_ttl = affinity_ttl
+        self._lease_lock = threading.Lock()
+        self._snapshot_lock = threading.RLock()
+        # guards the label index, the affinity and the slots, which are
+        # changed by the workers of a concurrent teardown
+        self._index_lock = threading.RLock()
+        # with `slots`, containers are named `<group>--0..slots-1` and
+        # `slot_list` holds the id and state of each slot
+        self.slots = slots
 
         if update_image:
             self.client.pull(specs['image'])
 
-    def get_container_list(self, status=False):
-        filters = dict(name='/{}--'.format(self.group_identifier))
+    @property
+    def revision(self):
+        # short, stable hash of the specs the containers are created with
+        return hashlib.sha1(json.dumps(
+            self.specs, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+    def get_labels(self, state):
+        labels = {
+            LABEL_GROUP: self.group_identifier,
+            LABEL_REVISION: self.revision,
+            LABEL_STATE: state
+        }
+        # identifies the containers of an interrupted operation
+        if self.journal.current_operation is not None:
+            labels[LABEL_OPERATION] = self.journal.current_operation
+        return labels
+
+    def get_container_list(self, status=False, labels=None):
+        # the group label matches exactly, unlike a name prefix filter
+        label_filters = ['{}={}'.format(LABEL_GROUP, self.group_identifier)]
+        for key, value in (labels or {}).items():
+            label_filters.append('{}={}'.format(key, value))
+
+        filters = dict(label=label_filters)
         if status:
             filters['status'] = status
 
-        return self.client.containers(all=True, filters=filters)
+        container_list = self.client.containers(all=True, filters=filters)
+        if status:
+            # a snapshot boot container is no member of the pool
+            container_list = [
+                c for c in container_list
+                if (c.get('Labels') or {}).get(LABEL_STATE) != SNAPSHOT_STATE]
+        if not status and not labels:
+            self._rebuild_label_index(container_list)
+            if self.slot_list is not None:
+                self._load_slots(container_list)
+        else:
+            for container in container_list:
+                self._index_container(
+                    container.get('Id'), container.get('Labels') or {})
+        return container_list
+
+    def get_container_ids(self, label=None, value=None):
+        # local lookup, no request to the docker daemon
+        if label is None:
+            label, value = LABEL_GROUP, self.group_identifier
+        with self._index_lock:
+            return set(self.label_index.get(
+                '{}={}'.format(label, value), ()))
+
+    def has_container(self, container_identifier):
+        container_ids = self.get_container_ids()
+        if container_identifier in container_ids:
+            return True
+        # docker accepts short ids as well
+        return any(
+            container_id.startswith(container_identifier)
+            for container_id in container_ids)
+
+    def check_container(self, container_identifier):
+        # a miss refreshes the index once, e.g. after a restart
+        if self.has_container(container_identifier):
+            return
+        self.get_container_list()
+        if not self.has_container(container_identifier):
+            raise DockerContainerGroupContainerNotFound(
+                'container {} is not in container group {}'.format(
+                    container_identifier, self.group_identifier))
+
+    def get_legacy_container_list(self):
+        # containers created without labels, by earlier versions
+        pattern = re.compile(r'^/{}--[0-9a-f-]{{36}}$'.format(
+            re.escape(self.group_identifier)))
+        return [
+            c for c in self.client.containers(all=True, filters=dict(
+                name='/{}--'.format(self.group_identifier)))
+            if LABEL_GROUP not in (c.get('Labels') or {}) and
+            any(pattern.match(name) for name in c.get('Names') or [])]
+
+    def _index_container(self, container_id, labels):
+        with self._index_lock:
+            for key, value in labels.items():
+                if key == LABEL_STATE:
+                    continue  # the state at creation, it is not updated
+                self.label_index.setdefault(
+                    '{}={}'.format(key, value), set()).add(container_id)
+
+    def _unindex_container(self, container_id):
+        with self._index_lock:
+            self.leased.discard(container_id)
+            self._drop_affinity(container_id)
+            self._free_slot(container_id)
+            for key in list(self.label_index):
+                container_ids = self.label_index.get(key)
+                if container_ids is None:
+                    continue
+                container_ids.discard(container_id)
+                if not container_ids:
+                    self.label_index.pop(key, None)
+
+    def _drop_affinity(self, container_id):
+        with self._index_lock:
+            for session_key, (container, _) in list(self.affinity.items()):
+                if container.get('Id') == container_id:
+                    self.affinity.pop(session_key, None)
+
+    def _expire_affinity(self):
+        now = time.time()
+        with self._index_lock:
+            for session_key, (_, expires) in list(self.affinity.items()):
+                if expires < now:
+                    self.affinity.pop(session_key, None)
+
+    def _rebuild_label_index(self, container_list):
+        with self._index_lock:
+            self.label_index = {}
+            for container in container_list:
+                self._index_container(
+                    container.get('Id'), container.get('Labels') or {})
 
     def get_available_container_list(self):
         return self.get_container_list(status=['created', 'exited'])
@@ -53,33 +242,190 @@ class DockerContainerGroup(object):
         return self.client.containers(all=True, filters=dict(
             id=container_identifier))[0]
 
-    def create_container(self, start=True, specs={}):
+    def update_specs(self, specs):
+        if specs != self.specs:
+            self.specs = specs
+            self.remove_snapshot()
+
+    @journaled
+    def create_container(self, start=True, specs={}, slot=None, lease=False):
         # http://docker-py.readthedocs.io/en/latest/api/#create_container
+        # with `lease`, the container is leased before it is started
+        self._check_draining()
+        if self.slots:
+            slot = self._reserve_slot(slot)
+            try:
+                return self._create_container(start, specs, slot, lease)
+            except Exception:
+                with self._index_lock:
+                    if self.slot_list[slot]['State'] == 'creating':
+                        self.slot_list[slot] = None
+                raise
+        return self._create_container(start, specs, lease=lease)
+
+    def _create_container(self, start, specs, slot=None, lease=False):
         predefined_specs = deepcopy(self.specs)
-        image = predefined_specs.pop('image')
+        image = self._get_image(predefined_specs.pop('image'))
 
         if specs:
             specs.pop('image', None)
             predefined_specs.update(specs)
 
         predefined_specs['name'] = '{}--{}'.format(
-            self.group_identifier, str(uuid.uuid4()))
+            self.group_identifier,
+            str(uuid.uuid4()) if slot is None else slot)
+
+        labels = predefined_specs.get('labels') or {}
+        if isinstance(labels, list):
+            # docker also accepts a list of label names without values
+            labels = dict((label, '') for label in labels)
+        labels = dict(labels)
+        labels.update(self.get_labels('running' if start else 'available'))
+        if slot is not None:
+            labels[LABEL_SLOT] = str(slot)
+        predefined_specs['labels'] = labels
 
         container = self.client.create_container(image, **predefined_specs)
-        if start:
-            self.client.start(container.get('Id'))
-
-        return self.get_container(container.get('Id'))
+        container_id = container.get('Id')
+        self._index_container(container_id, labels)
+        if lease:
+            # a concurrent acquire must not take it once it runs
+            with self._lease_lock:
+                self.leased.add(container_id)
+        try:
+            if start:
+                self.client.start(container_id)
+            if slot is None:
+                return self.get_container(container_id)
+        except Exception:
+            # the container keeps its name as long as it exists
+            self._remove_failed_container(
+                container_id, slot, predefined_specs['name'], labels)
+            raise
+
+        # the state is known, no listing necessary
+        return self._set_slot(slot, dict(
+            Id=container_id,
+            Names=['/' + predefined_specs['name']],
+            State='running' if start else 'created',
+            Labels=labels))
+
+    def _remove_failed_container(self, container_id, slot, name, labels):
+        try:
+            self.client.remove_container(container_id, force=True)
+        except APIError as e:
+            logger.error(e)
+            if slot is not None:
+                # taken until the slot is replaced
+                self.release_container(container_id)
+                self._set_slot(slot, dict(
+                    Id=container_id, Names=['/' + name], State='created',
+                    Labels=labels))
+                return
+        self._unindex_container(container_id)
 
     def start_container(self, container_identifier):
         # http://docker-py.readthedocs.io/en/latest/api/#start
+        self._check_draining()
         self.client.start(container_identifier)
-        return self.get_container(container_identifier)
+        return self._update_slot(self.get_container(container_identifier))
 
     def stop_container(self, container_identifier):
         # http://docker-py.readthedocs.io/en/latest/api/#stop
+        self._drop_affinity(container_identifier)
         self.client.stop(container_identifier)
-        return self.get_container(container_identifier)
+        return self._update_slot(self.get_container(container_identifier))
+
+    def get_slot(self, slot):
+        # local lookup, no request to the docker daemon
+        return self._get_slot_list()[self._check_slot(slot)]
+
+    def replace_slot(self, slot, start=True):
+        # replaces a dead (or any) container of the slot by a new one
+        self._check_draining()
+        entry = self._get_slot_list()[self._check_slot(slot)]
+        if entry is not None and entry.get('Id'):
+            self._stop_remove_container(entry)
+        try:
+            # the container may be gone without us knowing
+            self.client.remove_container(
+                '{}--{}'.format(self.group_identifier, slot), force=True)
+        except APIError:
+            pass
+        with self._index_lock:
+            self.slot_list[slot] = None
+        return self.create_container(start=start, slot=slot)
+
+    def _check_slot(self, slot):
+        if not isinstance(slot, int) or not 0 <= slot < self.slots:
+            raise DockerContainerGroupSlotNotFound(
+                'container group {} has no slot {}'.format(
+                    self.group_identifier, slot))
+        return slot
+
+    def _get_slot_list(self):
+        if not self.slots:
+            raise DockerContainerGroupException(
+                'container group {} has no slots'.format(
+                    self.group_identifier))
+        if self.slot_list is None:
+            self._load_slots(self.get_container_list())
+        return self.slot_list
+
+    def _load_slots(self, container_list):
+        # keeps the slots reserved by running container creations
+        with self._index_lock:
+            slot_list = self.slot_list or [None] * self.slots
+            self.slot_list = [
+                entry if entry is not None and entry['State'] == 'creating'
+                else None for entry in slot_list]
+            for container in container_list:
+                slot = (container.get('Labels') or {}).get(LABEL_SLOT)
+                if slot is not None and int(slot) < self.slots:
+                    self._set_slot(int(slot), container)
+
+    def _set_slot(self, slot, container):
+        with self._index_lock:
+            self.slot_list[slot] = dict(
+                Id=container.get('Id'),
+                Names=container.get('Names'),
+                State=container.get('State'),
+                Labels=container.get('Labels'),
+                Slot=slot)
+            return self.slot_list[slot]
+
+    def _reserve_slot(self, slot=None):
+        slot_list = self._get_slot_list()
+        with self._index_lock:
+            if slot is None:
+                free_slots = [
+                    i for i, entry in enumerate(slot_list) if entry is None]
+                if not free_slots:
+                    raise DockerContainerGroupException(
+                        'container group {} has no free slot'.format(
+                            self.group_identifier))
+                slot = free_slots[0]
+            elif slot_list[self._check_slot(slot)] is not None:
+                raise DockerContainerGroupException(
+                    'slot {} of container group {} is taken'.format(
+                        slot, self.group_identifier))
+            slot_list[slot] = dict(Id=None, State='creating', Slot=slot)
+            return slot
+
+    def _update_slot(self, container):
+        if self.slot_list is not None:
+            slot = (container.get('Labels') or {}).get(LABEL_SLOT)
+            if slot is not None and int(slot) < self.slots:
+                self._set_slot(int(slot), container)
+        return container
+
+    def _free_slot(self, container_id):
+        with self._index_lock:
+            if self.slot_list is None:
+                return
+            for slot, entry in enumerate(self.slot_list):
+                if entry is not None and entry.get('Id') == container_id:
+                    self.slot_list[slot] = None
 
     def exec_command_container(self, container_identifier, command):
         # http://docker-py.readthedocs.io/en/latest/api/#exec_create
@@ -90,11 +436,230 @@ class DockerContainerGroup(object):
         return self.client.exec_start(
             exec_id=exec_id)
 
-    def remove_all_container(self):
-        for container in self.get_container_list():
-            self.remove_container(container.get('Id'))
+    def get_affine_container(self, session_key):
+        # the container last acquired with `session_key`, if it is still
+        # running and nobody else acquired it in the meantime
+        self._check_draining()
+        with self._lease_lock:
+            entry = self.affinity.get(session_key)
+            if entry is None:
+                return None
+            container, expires = entry
+            container_id = container.get('Id')
+            if expires < time.time() or container_id in self.leased:
+                self.affinity.pop(session_key, None)
+                return None
+
+        try:
+            running = self.client.inspect_container(
+                container_id)['State']['Running']
+        except APIError:
+            running = False
+
+        with self._lease_lock:
+            if self.affinity.get(session_key) is not entry:
+                return None  # acquired by another caller while inspecting
+            if not running or container_id in self.leased:
+                self.affinity.pop(session_key, None)
+                return None
+            entry[1] = time.time() + self.affinity_ttl
+            self.leased.add(container_id)
+            return container
+
+    def exec_command_group(
+            self,
+            command,
+            container_identifiers=None,
+            workers=EXEC_WORKERS,
+            timeout=None):
+        '''
+        Runs the command on the given (default: all running) containers
+        with at most `workers` at a time and returns a generator of the
+        results as they finish. The command of a container still running
+        after `timeout` seconds is detached and yielded as timed out, it is
+        not killed inside the container.
+        '''
+        # listed before the first result is streamed, so errors of the
+        # docker daemon are reported as error responses
+        if container_identifiers is None:
+            container_identifiers = [
+                c.get('Id') for c in self.get_running_container_list()]
+        return self._exec_command_list(
+            command, container_identifiers, workers, timeout)
+
+    def _exec_command_list(
+            self, command, container_identifiers, workers, timeout):
+        if not container_identifiers:
+            return
 
+        thread_pool = ThreadPool(min(workers, len(container_identifiers)))
+        try:
+            for result in thread_pool.imap_unordered(
+                    lambda c: self._exec_command(c, command, timeout),
+                    container_identifiers):
+                yield result
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+    def _exec_command(self, container_id, command, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            exec_id = self.client.exec_create(
+                container=container_id, cmd=command)
+            sock = self.client.exec_start(exec_id=exec_id, socket=True)
+            try:
+                output = self._read_exec_output(sock, deadline)
+            finally:
+                sock.close()
+            if output is None:
+                return dict(Id=container_id, error='timeout')
+            exit_code = self.client.exec_inspect(exec_id).get('ExitCode')
+        except Exception as e:
+            # the result of this container, the other ones go on
+            logger.error(e)
+            return dict(Id=container_id, error=str(e))
+        return dict(Id=container_id, output=output, exit_code=exit_code)
+
+    def _read_exec_output(self, sock, deadline):
+        # the stdout and stderr frames of the exec socket until it is
+        # closed, None if the deadline passed before
+        data = b''
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+            ready, _, _ = select.select([sock], [], [], remaining)
+            if not ready:
+                return None
+            if hasattr(sock, 'recv'):
+                chunk = sock.recv(4096)
+            else:
+                chunk = os.read(sock.fileno(), 4096)
+            if not chunk:
+                break
+            data += chunk
+
+        output = b''
+        while len(data) >= 8:
+            _, size = struct.unpack('>BxxxL', data[:8])
+            output += data[8:8 + size]
+            data = data[8 + size:]
+        return output
+
+    @journaled
+    def acquire_container(self, count=1, session_key=None):
+        # hands out running containers which are not leased yet, then
+        # starts available containers and creates new ones, if necessary
+        # the affine container of `session_key` is checked by the pool
+        self._check_draining()
+        if session_key is not None:
+            count = 1
+        self.check_acquire_count(count)
+
+        # the lock is only held to pick and lease ids, the requests to the
+        # docker daemon run outside of it
+        container_list = []
+        leased = set()
+        try:
+            running_list = self.get_running_container_list()
+            with self._lease_lock:
+                for c in running_list:
+                    if len(container_list) == count:
+                        break
+                    if c.get('Id') not in self.leased:
+                        self.leased.add(c.get('Id'))
+                        leased.add(c.get('Id'))
+                        container_list.append(c)
+
+            if len(container_list) < count:
+                available_list = self.get_available_container_list()
+                with self._lease_lock:
+                    start_list = [
+                        c for c in available_list
+                        if c.get('Id') not in self.leased
+                    ][:count - len(container_list)]
+                    for c in start_list:
+                        self.leased.add(c.get('Id'))
+                        leased.add(c.get('Id'))
+                for c in start_list:
+                    container_list.append(self.start_container(c.get('Id')))
+
+            for _ in range(count - len(container_list)):
+                container = self.create_container(start=True, lease=True)
+                leased.add(container.get('Id'))
+                container_list.append(container)
+        except Exception:
+            # gives back what this acquire has leased so far
+            with self._lease_lock:
+                self.leased.difference_update(leased)
+            raise
+
+        with self._lease_lock:
+            for c in container_list:
+                # another session cannot get this container back
+                self._drop_affinity(c.get('Id'))
+            if session_key is not None:
+                self._expire_affinity()
+                self.affinity[session_key] = [
+                    container_list[0], time.time() + self.affinity_ttl]
+        return container_list
+
+    def check_acquire_count(self, count):
+        if count < 1 or (
+                self.max_count is not None and count > self.max_count):
+            raise DockerContainerGroupInvalidCount(
+                'cannot acquire {} container of container group {}'.format(
+                    count, self.group_identifier))
+
+    def release_container(self, container_identifier):
+        # the container keeps running and can be acquired again
+        with self._lease_lock:
+            self.leased.discard(container_identifier)
+
+    def remove_all_container(
+            self,
+            workers=TEARDOWN_WORKERS,
+            timeout=STOP_TIMEOUT,
+            progress=None):
+        self.remove_container_list(
+            self.get_container_list() + self.get_legacy_container_list(),
+            workers, timeout, progress)
+
+    def remove_container_list(
+            self,
+            container_list,
+            workers=TEARDOWN_WORKERS,
+            timeout=STOP_TIMEOUT,
+            progress=None):
+        # stop and remove the containers concurrently, with at most
+        # `workers` requests to the docker daemon at a time
+        total = len(container_list)
+        if not total:
+            return
+
+        thread_pool = ThreadPool(min(workers, total))
+        try:
+            results = thread_pool.imap_unordered(
+                lambda c: self._stop_remove_container(c, timeout),
+                container_list)
+            for done, _ in enumerate(results, 1):
+                if progress:
+                    progress(done, total)
+                else:
+                    logger.info('{}: removed {}/{} container'.format(
+                        self.group_identifier, done, total))
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+    @journaled
     def set_running_container(self, count):
+        if self.slots:
+            return self._set_running_slots(count)
+
         running_container_list = self.get_running_container_list()
         count_running = len(running_container_list)
         count_to_start = count - count_running
@@ -112,11 +677,71 @@ class DockerContainerGroup(object):
             for _ in range(count_to_start):
                 self.create_container(start=True)
         else:
+            # stop containers which are not acquired first
+            running_container_list.sort(
+                key=lambda c: c.get('Id') in self.leased)
             for i in range(count_running - count):
                 c = running_container_list[i]
                 self.stop_container(c.get('Id'))
 
+    def _set_running_slots(self, count):
+        # every slot is handled with its local state, without listing the
+        # group; containers which are not acquired are stopped first
+        self._check_draining()
+        slot_list = self._get_slot_list()
+        if count > self.slots:
+            raise DockerContainerGroupException(
+                'container group {} has only {} slots'.format(
+                    self.group_identifier, self.slots))
+
+        running_list = [
+            entry for entry in slot_list
+            if entry is not None and entry['State'] == 'running']
+        if count < len(running_list):
+            # the highest slots first
+            running_list.sort(key=lambda entry: (
+                entry['Id'] in self.leased, -entry['Slot']))
+            for entry in running_list[:len(running_list) - count]:
+                self._drop_affinity(entry['Id'])
+                self.client.stop(entry['Id'])
+                entry['State'] = 'exited'
+            return
+
+        count_to_start = count - len(running_list)
+        for entry in slot_list:
+            if count_to_start == 0:
+                return
+            if entry is not None and entry['State'] in ['created', 'exited']:
+                self.client.start(entry['Id'])
+                entry['State'] = 'running'
+                count_to_start -= 1
+
+        free_slots = [
+            slot for slot, entry in enumerate(slot_list) if entry is None]
+        for slot in free_slots[:count_to_start]:
+            self.create_container(start=True, slot=slot)
+
+    def prewarm(self, warm_count):
+        # raises the number of running, not acquired containers to
+        # `warm_count`, within `min_count` and `max_count` running containers
+        # and the slots
+        running_container_list = self.get_running_container_list()
+        count_leased = len([
+            c for c in running_container_list
+            if c.get('Id') in self.leased])
+        count = max(count_leased + warm_count, self.min_count)
+        if self.max_count is not None:
+            count = min(count, self.max_count)
+        if self.slots:
+            count = min(count, self.slots)
+        if count > len(running_container_list):
+            self.set_running_container(count)
+
+    @journaled
     def set_available_container(self, count):
+        if self.slots:
+            return self._set_available_slots(count)
+
         available_container_list = self.get_available_container_list()
         count_available = len(available_container_list)
         count_to_start = count - count_available
@@ -132,6 +757,28 @@ class DockerContainerGroup(object):
                 c = available_container_list[i]
                 self.remove_container(c.get('Id'))
 
+    def _set_available_slots(self, count):
+        slot_list = self._get_slot_list()
+        available_slots = [
+            slot for slot, entry in enumerate(slot_list)
+            if entry is not None and entry['State'] in ['created', 'exited']]
+        free_slots = [
+            slot for slot, entry in enumerate(slot_list) if entry is None]
+        if count > len(available_slots) + len(free_slots):
+            raise DockerContainerGroupException(
+                'container group {} has only {} slots for available '
+                'containers'.format(
+                    self.group_identifier,
+                    len(available_slots) + len(free_slots)))
+
+        if count > len(available_slots):
+            for slot in free_slots[:count - len(available_slots)]:
+                self.create_container(start=False, slot=slot)
+        else:
+            # frees the highest slots first
+            for slot in available_slots[count:]:
+                self._stop_remove_container(slot_list[slot])
+
     def remove_container(self, container_identifier):
         self._kill_remove_container(container_identifier)
 
@@ -149,6 +796,137 @@ class DockerContainerGroup(object):
             self.client.remove_container(container_id)
         except APIError as e:
             logger.error(e)  # This should work anyway (and I don't understand why)  # nopep8
+        self._unindex_container(container_id)
+
+    def build_snapshot(self):
+        # boot one container until it is ready and commit it as a group
+        # specific image, new containers are created from this image
+        with self._snapshot_lock:
+            revision = self.revision
+            try:
+                return self._build_snapshot(revision)
+            except Exception:
+                # `_get_image` does not try this revision again for a while
+                self.snapshot_failure = (revision, time.time())
+                raise
+
+    def _build_snapshot(self, revision):
+        self.remove_snapshot()
+        predefined_specs = deepcopy(self.specs)
+        image = predefined_specs.pop('image')
+        predefined_specs['name'] = '{}-snapshot-{}'.format(
+            self.group_identifier, str(uuid.uuid4()))
+        # the boot container is removed on group deletion, drain and
+        # recovery, if the server dies during the build; the containers
+        # created from the snapshot override these labels
+        labels = dict(predefined_specs.get('labels') or {})
+        labels.update(self.get_labels(SNAPSHOT_STATE))
+        predefined_specs['labels'] = labels
+
+        container_id = self.client.create_container(
+            image, **predefined_specs).get('Id')
+        try:
+            self.client.start(container_id)
+            self._wait_ready(container_id)
+            repository = SNAPSHOT_REPOSITORY.format(
+                self.group_identifier.lower())
+            # http://docker-py.readthedocs.io/en/latest/api/#commit
+            self.client.commit(
+                container_id, repository=repository, tag=revision)
+        finally:
+            self.client.remove_container(container_id, force=True)
+            self._unindex_container(container_id)
+
+        self.snapshot_image = '{}:{}'.format(repository, revision)
+        self.snapshot_revision = revision
+        self.snapshot_failure = None
+        return self.snapshot_image
+
+    def remove_snapshot(self):
+        if self.snapshot_image is None:
+            return
+        try:
+            self.client.remove_image(self.snapshot_image)
+        except APIError as e:
+            logger.error(e)  # still used by containers of the old revision
+        self.snapshot_image = None
+        self.snapshot_revision = None
+
+    def _get_image(self, image):
+        if not self.snapshot:
+            return image
+        revision = self.revision
+        if self.snapshot_revision == revision:
+            return self.snapshot_image
+
+        # the specs have changed since the snapshot was taken, concurrent
+        # creations wait for one build
+        with self._snapshot_lock:
+            if self.snapshot_revision == revision:
+                return self.snapshot_image
+            failure = self.snapshot_failure
+            if failure is not None and failure[0] == revision and \
+                    time.time() - failure[1] < SNAPSHOT_RETRY:
+                return image
+            try:
+                return self.build_snapshot()
+            except Exception as e:
+                logger.error(e)
+                return image
+
+    def _wait_ready(self, container_id):
+        # without a `ready_command` the container is ready after `delay`
+        ready_command = self.snapshot.get('ready_command')
+        if not ready_command:
+            time.sleep(self.snapshot.get('delay', 0))
+            return
+
+        timeout = self.snapshot.get('timeout', SNAPSHOT_TIMEOUT)
+        interval = self.snapshot.get('interval', SNAPSHOT_INTERVAL)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            exec_id = self.client.exec_create(
+                container=container_id, cmd=ready_command)
+            self.client.exec_start(exec_id=exec_id)
+            if self.client.exec_inspect(exec_id).get('ExitCode') == 0:
+                return
+            time.sleep(interval)
+
+        raise DockerContainerGroupException(
+            'snapshot container of {} not ready after {} seconds'.format(
+                self.group_identifier, timeout))
+
+    def _stop_remove_container(self, container, timeout=STOP_TIMEOUT):
+        # uses the state of the given container listing, no further lookup
+        container_id = container.get('Id')
+        if container.get('State') == 'running':
+            try:
+                # sends SIGTERM and kills the container after `timeout` seconds
+                self.client.stop(container_id, timeout=timeout)
+            except APIError as e:
+                logger.error(e)
+
+        try:
+            self.client.remove_container(container_id, force=True)
+        except APIError as e:
+            logger.error(e)
+        self._unindex_container(container_id)
+
+    def _check_draining(self):
+        if self.draining:
+            raise DockerContainerGroupDraining(
+                'container group {} is draining'.format(
+                    self.group_identifier))
 
     def to_dict(self):
-        return dict(specs=self.specs)
+        result = dict(specs=self.specs)
+        if self.min_count:
+            result['min_count'] = self.min_count
+        if self.max_count is not None:
+            result['max_count'] = self.max_count
+        if self.slots:
+            result['slots'] = self.slots
+        if self.snapshot:
+            result['snapshot'] = dict(
+                self.snapshot, image=self.snapshot_image)
+        return result
@@ -1,21 +1,65 @@
+import sys
 import docker
+import logging
+import threading
 
 from errors import (
     DockerContainerPoolException,
+    DockerContainerPoolDraining,
     DockerContainerPoolGroupNotFound,
     DockerContainerPoolGroupAlreadyDeclared
 )
-from docker_container_group import DockerContainerGroup
+from demand import DemandHistory
+from journal import Journal
+from tracing import Tracer, TracedClient
+from docker_container_group import (
+    DockerContainerGroup,
+    LABEL_GROUP,
+    LABEL_STATE,
+    LABEL_OPERATION,
+    SNAPSHOT_STATE,
+    TEARDOWN_WORKERS,
+    STOP_TIMEOUT
+)
+
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+# interrupted operations which are run again, or rolled back on recovery
+REPLAY_OPERATIONS = [
+    'update_container_group',
+    'delete_container_group',
+    'set_running_container',
+    'set_available_container'
+]
+ROLLBACK_OPERATIONS = [
+    'create_container',
+    'acquire_container'
+]
 
 
 class DockerContainerPool(object):
     client = None
+    tracer = None
+    demand = None
+    journal = None
     container_group_list = None
+    draining = False
+    drain_progress = None
 
-    def __init__(self, base_url):
+    def __init__(self, base_url, demand_store=None, journal=None):
         self.container_group_list = {}
+        self.drain_progress = dict(state='idle', total=0, done=0)
+        self._drain_lock = threading.Lock()
+        self.tracer = Tracer()
+        self.demand = DemandHistory(demand_store)
+        self.journal = Journal(journal)
         try:
-            self.client = docker.Client(base_url=base_url)
+            self.client = TracedClient(
+                docker.Client(base_url=base_url), self.tracer)
         except Exception:
             raise DockerContainerPoolException(message=str(Exception))
 
@@ -25,13 +69,200 @@ class DockerContainerPool(object):
         return self.container_group_list[group_identifier]
 
     def add_container_group(self, group_identifier, *args, **kwargs):
+        if self.draining:
+            raise DockerContainerPoolDraining('container pool is draining')
         if group_identifier in self.container_group_list:
             raise DockerContainerPoolGroupAlreadyDeclared()
+        with self.journal.operation(
+                'add_container_group', group_identifier,
+                args=list(args), kwargs=kwargs):
+            self._declare_container_group(group_identifier, *args, **kwargs)
+
+    def update_container_group(self, group_identifier, specs):
+        container_group = self.get_container_group(group_identifier)
+        with self.journal.operation(
+                'update_container_group', group_identifier, specs=specs):
+            container_group.update_specs(specs)
+
+    def acquire_container(self, group_identifier, count=1, session_key=None):
+        container_group = self.get_container_group(group_identifier)
+        if session_key is not None:
+            container = container_group.get_affine_container(session_key)
+            if container is not None:
+                return [container]
+            count = 1
+        container_group.check_acquire_count(count)
+        # only acquires which need another warm container are demand
+        self.demand.record(group_identifier, count)
+        return container_group.acquire_container(count, session_key)
+
+    def prewarm(self):
+        # starts containers ahead of the forecast demand
+        for group_identifier, container_group in list(
+                self.container_group_list.items()):
+            if container_group.draining:
+                continue
+            try:
+                container_group.prewarm(
+                    self.demand.forecast(group_identifier))
+            except Exception:
+                # the other groups are prewarmed anyway
+                logger.exception('prewarm of {} failed'.format(
+                    group_identifier))
+        self.demand.save()
+
+    def delete_container_group(
+            self,
+            group_identifier,
+            workers=TEARDOWN_WORKERS,
+            timeout=STOP_TIMEOUT,
+            progress=None):
+        container_group = self.get_container_group(group_identifier)
+        with self.journal.operation(
+                'delete_container_group', group_identifier,
+                workers=workers, timeout=timeout):
+            # no new containers while the group is torn down
+            container_group.draining = True
+            container_group.remove_all_container(workers, timeout, progress)
+            del self.container_group_list[group_identifier]
+
+    def recover(self, workers=TEARDOWN_WORKERS, timeout=STOP_TIMEOUT):
+        '''
+        Restores the container groups from the journal, runs interrupted
+        operations again or rolls them back and removes orphan containers.
+        '''
+        groups, pending = self.journal.read()
+        for group_identifier, declaration in groups.items():
+            kwargs = dict(declaration['kwargs'], update_image=False)
+            self._declare_container_group(
+                group_identifier, *declaration['args'], **kwargs)
+
+        # containers of groups which are not declared anymore, of
+        # interrupted container creations and snapshot builds, removed in
+        # bulk
+        rollback = set(
+            operation['id'] for operation in pending
+            if operation['operation'] in ROLLBACK_OPERATIONS)
+        orphan_lists = {}
+        try:
+            container_list = self.client.containers(
+                all=True, filters=dict(label=LABEL_GROUP))
+        except Exception:
+            # best effort, the pool starts anyway
+            logger.exception('recover: listing the containers failed')
+            container_list = []
+        for container in container_list:
+            labels = container.get('Labels') or {}
+            if labels.get(LABEL_GROUP) not in self.container_group_list \
+                    or labels.get(LABEL_OPERATION) in rollback \
+                    or labels.get(LABEL_STATE) == SNAPSHOT_STATE:
+                orphan_lists.setdefault(
+                    labels.get(LABEL_GROUP), []).append(container)
+
+        for group_identifier, container_list in orphan_lists.items():
+            logger.info('recover: remove {} orphan container of {}'.format(
+                len(container_list), group_identifier))
+            container_group = self.container_group_list.get(
+                group_identifier) or DockerContainerGroup(
+                    group_identifier, self.client, {})
+            try:
+                container_group.remove_container_list(
+                    container_list, workers, timeout)
+            except Exception:
+                logger.exception(
+                    'recover: removing the orphan container of {} '
+                    'failed'.format(group_identifier))
+
+        for operation in pending:
+            group_identifier = operation['group']
+            if operation['operation'] not in REPLAY_OPERATIONS or \
+                    group_identifier not in self.container_group_list:
+                continue
+            logger.info('recover: {operation} of {group}'.format(**operation))
+            if operation['operation'] in ['update_container_group',
+                                          'delete_container_group']:
+                target = self
+                operation['arguments']['group_identifier'] = group_identifier
+            else:
+                target = self.container_group_list[group_identifier]
+            try:
+                getattr(target, operation['operation'])(
+                    **operation['arguments'])
+            except Exception:
+                # not replayed again on the next start
+                logger.exception(
+                    'recover: {operation} of {group} failed'.format(
+                        **operation))
+                self.journal.fail(operation['id'])
+
+        for group_identifier, container_group in \
+                self.container_group_list.items():
+            groups[group_identifier]['kwargs']['specs'] = \
+                container_group.specs
+        self.journal.compact(dict(
+            (group_identifier, groups[group_identifier])
+            for group_identifier in self.container_group_list))
+
+    def _declare_container_group(self, group_identifier, *args, **kwargs):
         container_group = DockerContainerGroup(
             group_identifier, self.client, *args, **kwargs)
+        container_group.journal = self.journal
         self.container_group_list[group_identifier] = container_group
 
-    def delete_container_group(self, group_identifier):
-        container_group = self.container_group_list[group_identifier]
-        container_group.remove_all_container()
-        del self.container_group_list[group_identifier]
+    def drain(
+            self,
+            workers=TEARDOWN_WORKERS,
+            timeout=STOP_TIMEOUT,
+            background=False):
+        # host maintenance: remove the containers of all groups, but keep
+        # the groups declared, so they can be scaled up again on `resume`
+        with self._drain_lock:
+            if self.drain_progress['state'] == 'draining':
+                raise DockerContainerPoolDraining(
+                    'container pool is already draining')
+            self.draining = True
+            for container_group in self.container_group_list.values():
+                container_group.draining = True
+            self.drain_progress = dict(state='draining', total=0, done=0)
+
+        if background:
+            thread = threading.Thread(
+                target=self._drain, args=(workers, timeout))
+            thread.daemon = True
+            thread.start()
+        else:
+            self._drain(workers, timeout)
+
+    def _drain(self, workers, timeout):
+        def progress(done, total):
+            self.drain_progress['done'] += 1
+            logger.info('drain: removed {done}/{total} container'.format(
+                **self.drain_progress))
+
+        try:
+            container_lists = [
+                (container_group, container_group.get_container_list() +
+                 container_group.get_legacy_container_list())
+                for container_group in list(
+                    self.container_group_list.values())]
+            self.drain_progress['total'] = sum(
+                len(container_list) for _, container_list in container_lists)
+
+            for container_group, container_list in container_lists:
+                container_group.remove_container_list(
+                    container_list, workers, timeout, progress)
+        except Exception as e:
+            logger.exception('drain failed')
+            self.drain_progress.update(state='failed', message=str(e))
+        else:
+            self.drain_progress['state'] = 'drained'
+
+    def resume(self):
+        with self._drain_lock:
+            if self.drain_progress['state'] == 'draining':
+                raise DockerContainerPoolDraining(
+                    'container pool is still draining')
+            self.draining = False
+            for container_group in self.container_group_list.values():
+                container_group.draining = False
+            self.drain_progress = dict(state='idle', total=0, done=0)
@@ -11,5 +11,32 @@ class DockerContainerPoolGroupNotFound(DockerContainerPoolException):
     status_code = 404
 
 
+class DockerContainerPoolDraining(DockerContainerPoolException):
+    status_code = 503
+
+
 class DockerContainerGroupException(DockerContainerPoolException):
     pass
+
+
+class DockerContainerGroupDraining(DockerContainerGroupException):
+    status_code = 503
+
+
+class DockerContainerGroupContainerNotFound(DockerContainerGroupException):
+    status_code = 404
+
+
+class DockerContainerGroupSlotNotFound(DockerContainerGroupException):
+    status_code = 404
+
+
+class DockerContainerGroupInvalidCount(DockerContainerGroupException):
+    status_code = 400
+
+
+class DockerContainerPoolClientException(DockerContainerPoolException):
+    def __init__(self, message, status_code=500, error_type=None):
+        super(DockerContainerPoolClientException, self).__init__(message)
+        self.status_code = status_code
+        self.error_type = error_type
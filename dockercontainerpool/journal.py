@@ -0,0 +1,181 @@
+import os
+import json
+import uuid
+import inspect
+import functools
+import threading
+
+from contextlib import contextmanager
+
+
+__doc__ = '''
+This module is a write-ahead journal of the operations of the container
+pool.
+
+Every operation is appended as a `begin` record before it runs and as a
+`done` or `failed` record afterwards, so after a crash the operations
+which were interrupted are known. The journal also keeps the container
+group declarations, so the pool can be restored on startup. It is
+compacted whenever it grows beyond `max_size` bytes.
+'''
+
+BEGIN = 'begin'
+DONE = 'done'
+FAILED = 'failed'
+
+MAX_SIZE = 1024 * 1024
+
+
+class Journal(object):
+    '''
+    Without a path nothing is written.
+    '''
+    path = None
+    max_size = MAX_SIZE
+
+    def __init__(self, path=None, max_size=MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._file = None
+        self._compacted_size = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if path:
+            self._file = open(path, 'a')
+
+    @property
+    def current_operation(self):
+        # the outermost operation of this thread, the one which is replayed
+        # or rolled back after a crash
+        operations = getattr(self._local, 'operations', None)
+        return operations[0] if operations else None
+
+    @contextmanager
+    def operation(self, operation, group_identifier, **arguments):
+        if self._file is None:
+            yield None
+            return
+
+        operation_id = str(uuid.uuid4())
+        self._append(dict(
+            id=operation_id, status=BEGIN, operation=operation,
+            group=group_identifier, arguments=arguments))
+
+        operations = self._local.__dict__.setdefault('operations', [])
+        operations.append(operation_id)
+        status = FAILED
+        try:
+            yield operation_id
+            status = DONE
+        finally:
+            operations.pop()
+            self._append(dict(id=operation_id, status=status))
+
+    def fail(self, operation_id):
+        # finishes an operation of an earlier run, e.g. a failed replay
+        self._append(dict(id=operation_id, status=FAILED))
+
+    def read(self):
+        '''
+        Returns the declared container groups as dict
+        (group identifier -> dict(args, kwargs)) and the list of the
+        operations that were begun, but never finished.
+        '''
+        groups = {}
+        begun = {}
+        order = []
+        if not self.path or not os.path.exists(self.path):
+            return groups, []
+
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # the last line of a crash
+                if record['status'] == BEGIN:
+                    begun[record['id']] = record
+                    order.append(record['id'])
+                    continue
+                operation = begun.pop(record['id'], None)
+                if operation is not None and record['status'] == DONE:
+                    self._apply(groups, operation)
+
+        return groups, [begun[i] for i in order if i in begun]
+
+    def compact(self, groups):
+        # rewrites the journal with the group declarations only
+        if not self.path:
+            return
+        with self._lock:
+            self._compact(groups, [])
+
+    def _compact(self, groups, pending):
+        # the pending operations keep their begin records, so they are
+        # finished or recovered like before
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for group_identifier, declaration in groups.items():
+                operation_id = str(uuid.uuid4())
+                for record in (
+                        dict(id=operation_id, status=BEGIN,
+                             operation='add_container_group',
+                             group=group_identifier,
+                             arguments=declaration),
+                        dict(id=operation_id, status=DONE)):
+                    f.write(json.dumps(record) + '\n')
+            for record in pending:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            self._compacted_size = f.tell()
+        self._file.close()
+        os.rename(tmp_path, self.path)
+        self._file = open(self.path, 'a')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _append(self, record):
+        if self._file is None:
+            return
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            # at least twice the compacted size, so a journal of many
+            # groups is not compacted on every record
+            if self._file.tell() > max(
+                    self.max_size, 2 * self._compacted_size):
+                self._compact(*self.read())
+
+    def _apply(self, groups, operation):
+        group_identifier = operation['group']
+        arguments = operation['arguments']
+        if operation['operation'] == 'add_container_group':
+            groups[group_identifier] = arguments
+        elif operation['operation'] == 'update_container_group':
+            if group_identifier in groups:
+                groups[group_identifier]['kwargs']['specs'] = \
+                    arguments['specs']
+        elif operation['operation'] == 'delete_container_group':
+            groups.pop(group_identifier, None)
+
+
+def journaled(method):
+    '''
+    Journals the calls of a DockerContainerGroup method with its arguments.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.journal.path is None:
+            return method(self, *args, **kwargs)
+        arguments = inspect.getcallargs(method, self, *args, **kwargs)
+        del arguments['self']
+        with self.journal.operation(
+                method.__name__, self.group_identifier, **arguments):
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -1,13 +1,16 @@
 #! /usr/bin/env python
 import sys
 import json
+import time
 import click
 import logging
+import threading
 import traceback
 import docker.errors
 
-from flask import Flask, request, current_app
+from flask import Flask, Response, request, current_app
 
+from tracing import sample_stacks, PROFILE_MAX_SECONDS
 from docker_container_pool import DockerContainerPool
 
 
@@ -26,11 +29,68 @@ app.logger.addHandler(handler)
 @click.option('--port', '-p', default=5000)
 @click.option('--verbose', '-v', is_flag=True)
 @click.option('--dockerurl', '-u', default='unix://var/run/docker.sock')
-def cli(host, port, verbose, dockerurl):
+@click.option('--slow-threshold', default=1.0,
+              help='log operations slower than this (seconds)')
+@click.option('--profiler', is_flag=True,
+              help='enable the sampling profiler at /debug/profile')
+@click.option('--demand-store', default=None,
+              help='file to keep the acquire demand history in')
+@click.option('--prewarm-interval', default=60.0,
+              help='start containers ahead of the forecast demand every '
+                   'n seconds, 0 disables it')
+@click.option('--journal', default=None,
+              help='write-ahead journal file, the pool is recovered from it '
+                   'on startup')
+def cli(host, port, verbose, dockerurl, slow_threshold, profiler,
+        demand_store, prewarm_interval, journal):
     with app.app_context():
-        current_app.pool = DockerContainerPool(dockerurl)
+        current_app.pool = DockerContainerPool(
+            dockerurl, demand_store, journal)
+        current_app.pool.tracer.slow_threshold = slow_threshold
+        if journal:
+            current_app.pool.recover()
     app.config['VERBOSE'] = verbose
-    app.run(host=host, port=port)
+    app.config['PROFILER'] = profiler
+    if prewarm_interval:
+        thread = threading.Thread(
+            target=prewarm, args=(app.pool, prewarm_interval))
+        thread.daemon = True
+        thread.start()
+    app.run(host=host, port=port, threaded=True)
+
+
+def prewarm(pool, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            pool.prewarm()
+        except Exception:
+            app.logger.exception('prewarm failed')
+
+
+def dumps(obj):
+    with current_app.pool.tracer.span('json.dumps'):
+        return json.dumps(obj)
+
+
+def teardown_options(parsed_json):
+    # only these options of a request body are passed on
+    return dict(
+        (key, int(parsed_json[key])) for key in ['workers', 'timeout']
+        if key in parsed_json)
+
+
+@app.before_request
+def start_trace():
+    current_app.pool.tracer.start_trace(request.headers.get('X-Trace-Id'))
+
+
+@app.after_request
+def end_trace(response):
+    tracer = current_app.pool.tracer
+    tracer.end_trace('route.{}'.format(request.endpoint))
+    response.headers['X-Trace-Id'] = tracer.trace_id
+    return response
 
 
 @app.route("/container_group/<string:group_identifier>", methods=['POST'])
@@ -42,9 +102,17 @@ def add_container_group(group_identifier):
       "specs": {
                 "image": "redis",
                 "command": ""
-      }
+      },
+      "snapshot": {
+                "ready_command": "redis-cli ping",
+                "timeout": 120
+      },
+      "min_count": 1,
+      "max_count": 5,
+      "slots": 10
     }
     ```
+    `snapshot`, `min_count`, `max_count` and `slots` are optional, see README.md
     for more docker container options see: http://docker-py.readthedocs.io/en/latest/api/#create_container
     ATTENTION! Many options are deprecated
     '''
@@ -56,7 +124,7 @@ def add_container_group(group_identifier):
 @app.route("/container_group/<string:group_identifier>", methods=['GET'])
 def get_container_group(group_identifier):
     container_group = current_app.pool.get_container_group(group_identifier)
-    return json.dumps(container_group.to_dict()), 200, {
+    return dumps(container_group.to_dict()), 200, {
         'ContentType': 'application/json'}
 
 
@@ -64,13 +132,34 @@ def get_container_group(group_identifier):
 def update_container_group(group_identifier):
     parsed_json = request.get_json()
     container_group = current_app.pool.get_container_group(group_identifier)
-    container_group.specs = parsed_json.get('specs', container_group.specs)
+    current_app.pool.update_container_group(
+        group_identifier, parsed_json.get('specs', container_group.specs))
     return '', 200, {'ContentType': 'application/json'}
 
 
+@app.route("/container_group/<string:group_identifier>/snapshot", methods=['POST'])  # nopep8
+def build_snapshot(group_identifier):
+    container_group = current_app.pool.get_container_group(group_identifier)
+    image = container_group.build_snapshot()
+    return dumps(dict(image=image)), 200, {
+        'ContentType': 'application/json'}
+
+
 @app.route("/container_group/<string:group_identifier>", methods=['DELETE'])
 def delete_container_group(group_identifier):
-    current_app.pool.delete_container_group(group_identifier)
+    '''  # nopep8
+    The request body is optional:
+    ```json
+    {
+      "workers": 10,
+      "timeout": 10
+    }
+    ```
+    `workers` containers are stopped and removed concurrently, running containers are killed after `timeout` seconds
+    '''
+    parsed_json = request.get_json(silent=True) or {}
+    current_app.pool.delete_container_group(
+        group_identifier, **teardown_options(parsed_json))
     return '', 200, {'ContentType': 'application/json'}
 
 
@@ -78,14 +167,15 @@ def delete_container_group(group_identifier):
 def get_container_list(group_identifier):
     container_group = current_app.pool.get_container_group(group_identifier)
     container_list = container_group.get_container_list()
-    return json.dumps(container_list), 200, {'ContentType': 'application/json'}
+    return dumps(container_list), 200, {'ContentType': 'application/json'}
 
 
 @app.route("/container_group/<string:group_identifier>/container/<string:container_identifier>", methods=['GET'])  # nopep8
 def get_container(group_identifier, container_identifier):
     container_group = current_app.pool.get_container_group(group_identifier)
+    container_group.check_container(container_identifier)
     container = container_group.get_container(container_identifier)
-    return json.dumps(container), 200, {'ContentType': 'application/json'}
+    return dumps(container), 200, {'ContentType': 'application/json'}
 
 
 @app.route("/container_group/<string:group_identifier>/container", methods=['POST'])  # nopep8
@@ -104,21 +194,46 @@ def create_container(group_identifier):
     parsed_json = request.get_json()
     container_group = current_app.pool.get_container_group(group_identifier)
     container = container_group.create_container(**parsed_json)
-    return json.dumps(container), 200, {'ContentType': 'application/json'}
+    return dumps(container), 200, {'ContentType': 'application/json'}
+
+
+@app.route("/container_group/<string:group_identifier>/slot/<int:slot>", methods=['GET'])  # nopep8
+def get_slot(group_identifier, slot):
+    container_group = current_app.pool.get_container_group(group_identifier)
+    container = container_group.get_slot(slot)
+    return dumps(container), 200, {'ContentType': 'application/json'}
+
+
+@app.route("/container_group/<string:group_identifier>/slot/<int:slot>/replace", methods=['POST'])  # nopep8
+def replace_slot(group_identifier, slot):
+    '''  # nopep8
+    Removes the container of the slot and creates a new one. The request body is optional:
+    ```json
+    {
+      "start": true
+    }
+    ```
+    '''
+    parsed_json = request.get_json(silent=True) or {}
+    container_group = current_app.pool.get_container_group(group_identifier)
+    container = container_group.replace_slot(slot, **parsed_json)
+    return dumps(container), 200, {'ContentType': 'application/json'}
 
 
 @app.route("/container_group/<string:group_identifier>/container/<string:container_identifier>/start", methods=['POST'])  # nopep8
 def start_container(group_identifier, container_identifier):
     container_group = current_app.pool.get_container_group(group_identifier)
+    container_group.check_container(container_identifier)
     container = container_group.start_container(container_identifier)
-    return json.dumps(container), 200, {'ContentType': 'application/json'}
+    return dumps(container), 200, {'ContentType': 'application/json'}
 
 
 @app.route("/container_group/<string:group_identifier>/container/<string:container_identifier>/stop", methods=['POST'])  # nopep8
 def stop_container(group_identifier, container_identifier):
     container_group = current_app.pool.get_container_group(group_identifier)
+    container_group.check_container(container_identifier)
     container = container_group.stop_container(container_identifier)
-    return json.dumps(container), 200, {'ContentType': 'application/json'}
+    return dumps(container), 200, {'ContentType': 'application/json'}
 
 
 @app.route("/container_group/<string:group_identifier>/container/<string:container_identifier>/exec", methods=['POST'])  # nopep8
@@ -133,18 +248,80 @@ def exec_command_container(group_identifier, container_identifier):
     '''
     parsed_json = request.get_json()
     container_group = current_app.pool.get_container_group(group_identifier)
+    container_group.check_container(container_identifier)
     result = container_group.exec_command_container(
         container_identifier, parsed_json.get("command"))
-    return json.dumps(result), 200, {'ContentType': 'application/json'}
+    return dumps(result), 200, {'ContentType': 'application/json'}
+
+
+@app.route("/container_group/<string:group_identifier>/exec", methods=['POST'])  # nopep8
+def exec_command_group(group_identifier):
+    '''  # nopep8
+    Runs the command concurrently on all running containers of the group, or on the listed ones.
+    The request body must be like this structure:
+    ```json
+    {
+      "command": "",
+      "container": ["containerid_1", "containerid_2"],
+      "workers": 10,
+      "timeout": 30
+    }
+    ```
+    only `command` is required. The results are streamed as one json object per line, as they finish:
+    `{"Id": "containerid_1", "output": "...", "exit_code": 0}` or `{"Id": "containerid_2", "error": "timeout"}`
+    '''
+    parsed_json = request.get_json()
+    container_group = current_app.pool.get_container_group(group_identifier)
+    for container_identifier in parsed_json.get('container') or []:
+        container_group.check_container(container_identifier)
+    kwargs = dict(
+        container_identifiers=parsed_json.get('container'),
+        timeout=parsed_json.get('timeout'))
+    if 'workers' in parsed_json:
+        kwargs['workers'] = int(parsed_json['workers'])
+    results = container_group.exec_command_group(
+        parsed_json.get('command'), **kwargs)
+    return Response(
+        (json.dumps(result) + '\n' for result in results),
+        mimetype='application/x-ndjson')
 
 
 @app.route("/container_group/<string:group_identifier>/container/<string:container_identifier>", methods=['DELETE'])  # nopep8
 def remove_container(group_identifier, container_identifier):
     container_group = current_app.pool.get_container_group(group_identifier)
+    container_group.check_container(container_identifier)
     container_group.remove_container(container_identifier)
     return '', 200, {'ContentType': 'application/json'}
 
 
+@app.route("/container_group/<string:group_identifier>/acquire", methods=['POST'])  # nopep8
+def acquire_container(group_identifier):
+    '''  # nopep8
+    Returns a list of running containers, which are not acquired by someone else.
+    The request body is optional:
+    ```json
+    {
+      "count": 1,
+      "session_key": "user-1234"
+    }
+    ```
+    With a `session_key` the container last acquired with the same key is returned (again), if it is still running.
+    '''
+    parsed_json = request.get_json(silent=True) or {}
+    container_list = current_app.pool.acquire_container(
+        group_identifier, int(parsed_json.get('count', 1)),
+        parsed_json.get('session_key'))
+    return dumps(container_list), 200, {'ContentType': 'application/json'}
+
+
+@app.route("/container_group/<string:group_identifier>/container/<string:container_identifier>/release", methods=['POST'])  # nopep8
+def release_container(group_identifier, container_identifier):
+    container_group = current_app.pool.get_container_group(group_identifier)
+    container_group.check_container(container_identifier)
+    container_group.release_container(container_identifier)
+    return '', 200, {'ContentType': 'application/json'}
+
+
 @app.route("/container_group/<string:group_identifier>/set_running_container", methods=['POST'])  # nopep8
 def set_running_container(group_identifier):
     parsed_json = request.get_json()
@@ -161,6 +338,60 @@ def set_available_container(group_identifier):
     return '', 200, {'ContentType': 'application/json'}
 
 
+@app.route("/drain", methods=['POST'])
+def drain():
+    '''  # nopep8
+    Removes the containers of all container groups in the background, the container groups stay declared.
+    The request body is optional:
+    ```json
+    {
+      "workers": 10,
+      "timeout": 10
+    }
+    ```
+    '''
+    parsed_json = request.get_json(silent=True) or {}
+    current_app.pool.drain(background=True, **teardown_options(parsed_json))
+    return '', 202, {'ContentType': 'application/json'}
+
+
+@app.route("/drain", methods=['GET'])
+def get_drain_progress():
+    return dumps(current_app.pool.drain_progress), 200, {
+        'ContentType': 'application/json'}
+
+
+@app.route("/drain", methods=['DELETE'])
+def resume():
+    '''
+    Ends the drain, not possible while the containers are still removed.
+    '''
+    current_app.pool.resume()
+    return '', 200, {'ContentType': 'application/json'}
+
+
+@app.route("/debug/trace_stats", methods=['GET'])
+def get_trace_stats():
+    return dumps(current_app.pool.tracer.stats), 200, {
+        'ContentType': 'application/json'}
+
+
+@app.route("/debug/profile", methods=['GET'])
+def profile():
+    '''
+    Samples the stacks of all threads for `seconds` (query parameter, at
+    most PROFILE_MAX_SECONDS).
+    Only available, if the server is started with --profiler
+    '''
+    if not app.config.get('PROFILER', False):
+        return dumps(dict(message='profiler is disabled')), 404, {
+            'ContentType': 'application/json'}
+    seconds = min(
+        max(float(request.args.get('seconds', 5)), 0), PROFILE_MAX_SECONDS)
+    return dumps(sample_stacks(seconds)), 200, {
+        'ContentType': 'application/json'}
+
+
 @app.errorhandler(Exception)
 def unhandled_exception(error):
     status = 500 if not hasattr(error, 'status_code') else error.status_code
@@ -176,7 +407,7 @@ def unhandled_exception(error):
         error_type=error.__class__.__name__)
     if app.config.get('VERBOSE', False):
         response['traceback'] = traceback.format_exc()
-    return json.dumps(response), status, {
+    return dumps(response), status, {
         'ContentType': 'application/json'}
 
 
@@ -0,0 +1,126 @@
+import sys
+import time
+import uuid
+import logging
+import threading
+import traceback
+
+from contextlib import contextmanager
+
+
+__doc__ = '''
+This module traces requests and docker client calls and logs slow operations.
+'''
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+SLOW_THRESHOLD = 1.0
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 30
+
+
+class Tracer(object):
+    slow_threshold = SLOW_THRESHOLD
+    stats = None
+
+    def __init__(self, slow_threshold=SLOW_THRESHOLD):
+        self.slow_threshold = slow_threshold
+        self.stats = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def trace_id(self):
+        return getattr(self._local, 'trace_id', None)
+
+    def start_trace(self, trace_id=None):
+        self._local.trace_id = trace_id or uuid.uuid4().hex
+        self._local.spans = []
+        self._local.start = time.time()
+        return self._local.trace_id
+
+    def end_trace(self, name):
+        # records the whole trace as span `name` and logs the spans of
+        # slow traces
+        duration = time.time() - self._local.start
+        spans = self._local.spans
+        self._local.spans = None
+        self._record(name, duration)
+        if duration >= self.slow_threshold:
+            logger.warning('slow trace {} {} {:.3f}s: {}'.format(
+                self.trace_id, name, duration, ', '.join(
+                    '{} {:.3f}s'.format(*span) for span in spans)))
+        return duration
+
+    @contextmanager
+    def span(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            self._record(name, duration)
+            spans = getattr(self._local, 'spans', None)
+            if spans is not None:
+                spans.append((name, duration))
+
+    def _record(self, name, duration):
+        with self._lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = dict(count=0, total=0.0, max=0.0)
+            stat['count'] += 1
+            stat['total'] += duration
+            stat['max'] = max(stat['max'], duration)
+
+
+class TracedClient(object):
+    '''
+    Wraps a docker client, every method call is recorded as a span.
+    '''
+    def __init__(self, client, tracer):
+        self._client = client
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        span_name = 'docker.{}'.format(name)
+
+        def traced(*args, **kwargs):
+            with self._tracer.span(span_name):
+                return attr(*args, **kwargs)
+
+        # cached, __getattr__ is only called for missing attributes
+        setattr(self, name, traced)
+        return traced
+
+
+def sample_stacks(seconds, interval=PROFILE_INTERVAL, limit=20):
+    # sampling profiler: counts the stacks of all other threads
+    own_thread_id = threading.current_thread().ident
+    counts = {}
+    deadline = time.time() + seconds
+    samples = 0
+    while time.time() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+            stack = ';'.join(
+                '{}:{}:{}'.format(filename, lineno, function)
+                for filename, lineno, function, _
+                in traceback.extract_stack(frame))
+            counts[stack] = counts.get(stack, 0) + 1
+        samples += 1
+        time.sleep(interval)
+
+    top = sorted(counts.items(), key=lambda item: item[1], reverse=True)
+    return dict(
+        samples=samples,
+        stacks=[dict(stack=stack, count=count)
+                for stack, count in top[:limit]])
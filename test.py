@@ -1,10 +1,20 @@
+import os
 import json
+import time
+import socket
+import struct
+import tempfile
 import unittest
+import threading
 from docker.errors import APIError
 from mock import Mock, patch, call
 from flask import current_app
 from dockercontainerpool.server import app
+from dockercontainerpool.client import DockerContainerPoolClient
+from dockercontainerpool.demand import DemandHistory
+from dockercontainerpool.journal import Journal
 from dockercontainerpool.docker_container_pool import DockerContainerPool
+from dockercontainerpool.errors import DockerContainerPoolClientException
 
 
 class DockerContainerPoolTestCase(unittest.TestCase):
@@ -24,6 +34,7 @@ class DockerContainerPoolTestCase(unittest.TestCase):
         with app.app_context() as app_context:
             current_app.pool = DockerContainerPool(
                 'unix://path/to/docker.sock')
+            self.pool = current_app.pool
 
         app.config['VERBOSE'] = True
 
@@ -126,8 +137,12 @@ class DockerContainerPoolTestCase(unittest.TestCase):
         self.assertEqual(200, result.status_code)
 
         self.assertTrue(container_list[0] == json.loads(result.data))
+        revision = self.pool.get_container_group('redis').revision
         self.assertEqual(
-            call(u'redis', name='redis--aaaa-aaaa-aaaa-aaaa'),
+            call(u'redis', name='redis--aaaa-aaaa-aaaa-aaaa', labels={
+                'dockercontainerpool.group': 'redis',
+                'dockercontainerpool.revision': revision,
+                'dockercontainerpool.state': 'available'}),
             self.docker_client_mock.create_container.call_args)
 
         headers = {"Content-Type": "application/json"}
@@ -140,6 +155,523 @@ class DockerContainerPoolTestCase(unittest.TestCase):
         self.assertTrue(container_list[1] == json.loads(result.data))
         self.assertEqual(200, result.status_code)
 
+    def test_get_container_list(self):
+        self._set_container_group()
+        self._set_container_group('redis--cache')
+
+        container = self._get_container_response('containerid_1')
+        container[u'Labels'] = {u'dockercontainerpool.group': u'redis'}
+        self.docker_client_mock.containers.return_value = [container]
+
+        result = self.client.get('/container_group/redis/container')
+        self.assertEqual(200, result.status_code)
+        self.assertEqual([container], json.loads(result.data))
+        self.assertEqual(
+            call(all=True, filters={
+                'label': ['dockercontainerpool.group=redis']}),
+            self.docker_client_mock.containers.call_args)
+
+        container_group = self.pool.get_container_group('redis')
+        self.assertTrue(container_group.has_container('containerid_1'))
+        self.assertEqual(set(), self.pool.get_container_group(
+            'redis--cache').get_container_ids())
+
+    def test_create_container_from_snapshot(self):
+        headers = {"Content-Type": "application/json"}
+        self.client.post(
+            '/container_group/redis',
+            headers=headers, data=json.dumps({
+                "specs": {"image": "redis"},
+                "snapshot": {"ready_command": "redis-cli ping"}
+            }))
+        container_group = self.pool.get_container_group('redis')
+        revision = container_group.revision
+
+        container = self._get_container_response('containerid_1')
+        self.docker_client_mock.create_container.return_value = container
+        self.docker_client_mock.containers.return_value = [container]
+        self.docker_client_mock.exec_create.return_value = 'exec_id'
+        self.docker_client_mock.exec_inspect.return_value = dict(ExitCode=0)
+
+        for _ in range(2):
+            result = self.client.post(
+                '/container_group/redis/container',
+                headers=headers, data=json.dumps({"start": False}))
+            self.assertEqual(200, result.status_code)
+
+        # the snapshot is built once
+        self.assertEqual(
+            [call(u'containerid_1',
+                  repository=u'dockercontainerpool-snapshot/redis',
+                  tag=revision)],
+            self.docker_client_mock.commit.call_args_list)
+        # the boot container is labeled, so recovery can remove it
+        labels = self.docker_client_mock.create_container.call_args_list[
+            0][1]['labels']
+        self.assertEqual('redis', labels['dockercontainerpool.group'])
+        self.assertEqual('snapshot', labels['dockercontainerpool.state'])
+        image = 'dockercontainerpool-snapshot/redis:' + revision
+        self.assertEqual(
+            image, self.docker_client_mock.create_container.call_args[0][0])
+
+        # changing the specs invalidates the snapshot
+        result = self.client.put(
+            '/container_group/redis',
+            headers=headers, data=json.dumps({"specs": {"image": "redis:3"}}))
+        self.assertEqual(200, result.status_code)
+        self.assertEqual(
+            call(image), self.docker_client_mock.remove_image.call_args)
+        self.assertIsNone(container_group.snapshot_image)
+
+    def test_create_container_snapshot_failed(self):
+        headers = {"Content-Type": "application/json"}
+        self.client.post(
+            '/container_group/redis',
+            headers=headers, data=json.dumps({
+                "specs": {"image": "redis"},
+                "snapshot": {"delay": 0}
+            }))
+
+        container = self._get_container_response('containerid_1')
+        self.docker_client_mock.create_container.return_value = container
+        self.docker_client_mock.containers.return_value = [container]
+        self.docker_client_mock.commit.side_effect = APIError(
+            Mock(), Mock(), "explanation")
+
+        for _ in range(3):
+            result = self.client.post(
+                '/container_group/redis/container',
+                headers=headers, data=json.dumps({"start": False}))
+            self.assertEqual(200, result.status_code)
+            self.assertEqual(
+                u'redis',
+                self.docker_client_mock.create_container.call_args[0][0])
+
+        # the failed build is not repeated for every container
+        self.assertEqual(1, self.docker_client_mock.commit.call_count)
+
+        # until the specs change
+        self.client.put(
+            '/container_group/redis',
+            headers=headers, data=json.dumps({"specs": {"image": "redis:3"}}))
+        self.client.post(
+            '/container_group/redis/container',
+            headers=headers, data=json.dumps({"start": False}))
+        self.assertEqual(2, self.docker_client_mock.commit.call_count)
+
+    def test_trace(self):
+        self._set_container_group()
+        self.docker_client_mock.containers.return_value = []
+
+        result = self.client.get(
+            '/container_group/redis/container',
+            headers={'X-Trace-Id': 'mytraceid'})
+        self.assertEqual(200, result.status_code)
+        self.assertEqual('mytraceid', result.headers['X-Trace-Id'])
+
+        result = self.client.get('/container_group/redis')
+        self.assertEqual(32, len(result.headers['X-Trace-Id']))
+
+        stats = json.loads(self.client.get('/debug/trace_stats').data)
+        self.assertEqual(1, stats['docker.containers']['count'])
+        self.assertEqual(1, stats['route.get_container_list']['count'])
+        self.assertEqual(2, stats['json.dumps']['count'])
+
+        result = self.client.get('/debug/profile?seconds=0.1')
+        self.assertEqual(404, result.status_code)
+
+    @patch('dockercontainerpool.server.sample_stacks')
+    def test_profile(self, sample_stacks):
+        sample_stacks.return_value = dict(samples=0, stacks=[])
+        app.config['PROFILER'] = True
+        try:
+            result = self.client.get('/debug/profile?seconds=3600')
+        finally:
+            app.config['PROFILER'] = False
+        self.assertEqual(200, result.status_code)
+        self.assertEqual(call(30), sample_stacks.call_args)
+
+    def test_acquire_release_container(self):
+        self._set_container_group()
+
+        running = self._get_container_response('containerid_1', 'running')
+        created = self._get_container_response('containerid_2', 'created')
+        started = self._get_container_response('containerid_2', 'running')
+        self.docker_client_mock.containers.side_effect = [
+            [running], [created], [started],
+            [running, started], [],
+        ]
+
+        headers = {"Content-Type": "application/json"}
+        result = self.client.post(
+            '/container_group/redis/acquire',
+            headers=headers, data=json.dumps(dict(count=2)))
+        self.assertEqual(200, result.status_code)
+        self.assertEqual([running, started], json.loads(result.data))
+        self.assertEqual(
+            call(u'containerid_2'), self.docker_client_mock.start.call_args)
+
+        # all running containers are acquired, a new one is created
+        created = self._get_container_response('containerid_3', 'running')
+        self.docker_client_mock.create_container.return_value = created
+        self.docker_client_mock.containers.side_effect = [
+            [running, started], [], [created]]
+        result = self.client.post('/container_group/redis/acquire')
+        self.assertEqual([created], json.loads(result.data))
+
+        result = self.client.post(
+            '/container_group/redis/container/containerid_1/release')
+        self.assertEqual(200, result.status_code)
+        self.assertEqual(
+            set(['containerid_2', 'containerid_3']),
+            self.pool.get_container_group('redis').leased)
+
+    def test_acquire_container_lock(self):
+        self._set_container_group()
+        container_group = self.pool.get_container_group('redis')
+
+        running = self._get_container_response('containerid_1', 'running')
+        created = self._get_container_response('containerid_2', 'running')
+        self.docker_client_mock.containers.side_effect = [
+            [running], [], [created]]
+        creating = threading.Event()
+        proceed = threading.Event()
+
+        def create_container(image, **specs):
+            creating.set()
+            proceed.wait(5)
+            return created
+        self.docker_client_mock.create_container.side_effect = \
+            create_container
+
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.extend(
+            container_group.acquire_container(2)))
+        thread.start()
+        self.assertTrue(creating.wait(5))
+
+        # a release does not wait for the container creation
+        released = threading.Event()
+        releasing = threading.Thread(target=lambda: (
+            container_group.release_container('containerid_3'),
+            released.set()))
+        releasing.start()
+        self.assertTrue(released.wait(1))
+        proceed.set()
+        thread.join()
+        self.assertEqual([running, created], acquired)
+        self.assertEqual(
+            set(['containerid_1', 'containerid_2']), container_group.leased)
+
+        # a failed acquire gives its containers back
+        container_group.leased.clear()
+        self.docker_client_mock.containers.side_effect = [[running], []]
+        self.docker_client_mock.create_container.side_effect = APIError(
+            Mock(), Mock(), "explanation")
+        with self.assertRaises(APIError):
+            container_group.acquire_container(2)
+        self.assertEqual(set(), container_group.leased)
+
+    def test_acquire_container_invalid_count(self):
+        headers = {"Content-Type": "application/json"}
+        self.client.post(
+            '/container_group/redis',
+            headers=headers, data=json.dumps({
+                "specs": {"image": "redis"},
+                "max_count": 3
+            }))
+        self.docker_client_mock.containers.return_value = [
+            self._get_container_response('containerid_1', 'running')]
+
+        for count in [0, -1, 4]:
+            result = self.client.post(
+                '/container_group/redis/acquire',
+                headers=headers, data=json.dumps(dict(count=count)))
+            self.assertEqual(400, result.status_code)
+            self.assertEqual(
+                "DockerContainerGroupInvalidCount",
+                json.loads(result.data).get("error_type"))
+        self.assertEqual(set(), self.pool.get_container_group('redis').leased)
+        self.assertEqual({}, self.pool.demand.current)
+
+    def test_acquire_container_session_key(self):
+        self._set_container_group()
+
+        running = self._get_container_response('containerid_1', 'running')
+        self.docker_client_mock.containers.return_value = [running]
+        self.docker_client_mock.inspect_container.return_value = {
+            'State': {'Running': True}}
+
+        headers = {"Content-Type": "application/json"}
+        data = json.dumps(dict(session_key='user-1'))
+        result = self.client.post(
+            '/container_group/redis/acquire', headers=headers, data=data)
+        self.assertEqual([running], json.loads(result.data))
+        self.assertEqual(1, self.docker_client_mock.containers.call_count)
+
+        self.client.post(
+            '/container_group/redis/container/containerid_1/release')
+
+        # the same container, without listing the containers
+        result = self.client.post(
+            '/container_group/redis/acquire', headers=headers, data=data)
+        self.assertEqual([running], json.loads(result.data))
+        self.assertEqual(1, self.docker_client_mock.containers.call_count)
+        self.docker_client_mock.inspect_container.assert_called_with(
+            'containerid_1')
+
+        # a container acquired by another caller is not handed out twice
+        self.client.post(
+            '/container_group/redis/container/containerid_1/release')
+        result = self.client.post(
+            '/container_group/redis/acquire', headers=headers,
+            data=json.dumps(dict(count=1)))
+        self.assertEqual([running], json.loads(result.data))
+        other = self._get_container_response('containerid_2', 'running')
+        self.docker_client_mock.containers.return_value = [running, other]
+        result = self.client.post(
+            '/container_group/redis/acquire', headers=headers, data=data)
+        self.assertEqual([other], json.loads(result.data))
+
+        # a container which is not running anymore is not returned again
+        self.client.post(
+            '/container_group/redis/container/containerid_1/release')
+        self.client.post(
+            '/container_group/redis/container/containerid_2/release')
+        self.docker_client_mock.inspect_container.return_value = {
+            'State': {'Running': False}}
+        self.docker_client_mock.containers.return_value = [running]
+        result = self.client.post(
+            '/container_group/redis/acquire', headers=headers, data=data)
+        self.assertEqual([running], json.loads(result.data))
+
+    def test_prewarm(self):
+        headers = {"Content-Type": "application/json"}
+        self.client.post(
+            '/container_group/redis',
+            headers=headers, data=json.dumps({
+                "specs": {"image": "redis"},
+                "min_count": 1,
+                "max_count": 3
+            }))
+        container_group = self.pool.get_container_group('redis')
+        container_group.set_running_container = Mock()
+        running = self._get_container_response('containerid_1', 'running')
+        self.docker_client_mock.containers.return_value = [running]
+
+        # no demand
+        self.pool.prewarm()
+        self.assertFalse(container_group.set_running_container.called)
+
+        self.pool.demand.forecast = Mock(return_value=5)
+        self.pool.prewarm()
+        self.assertEqual(
+            call(3), container_group.set_running_container.call_args)
+
+    def test_prewarm_slots(self):
+        headers = {"Content-Type": "application/json"}
+        for group_identifier, options in [
+                ('aslots', {"slots": 2}), ('broken', {}), ('redis', {})]:
+            options['specs'] = {"image": "redis"}
+            self.client.post(
+                '/container_group/' + group_identifier,
+                headers=headers, data=json.dumps(options))
+        self.docker_client_mock.containers.return_value = []
+        self.docker_client_mock.create_container.side_effect = [
+            dict(Id='containerid_0'), dict(Id='containerid_1')]
+        broken = self.pool.get_container_group('broken')
+        broken.set_running_container = Mock(side_effect=APIError(
+            Mock(), Mock(), "explanation"))
+        redis = self.pool.get_container_group('redis')
+        redis.set_running_container = Mock()
+        self.pool.demand.save = Mock()
+        self.pool.demand.forecast = Mock(return_value=5)
+
+        # capped at the slots, a failing group does not stop the others
+        self.pool.prewarm()
+        self.assertEqual(
+            ['aslots--0', 'aslots--1'],
+            [c[1]['name'] for c in
+             self.docker_client_mock.create_container.call_args_list])
+        self.assertEqual(call(5), redis.set_running_container.call_args)
+        self.assertTrue(self.pool.demand.save.called)
+
+    def test_slots(self):
+        headers = {"Content-Type": "application/json"}
+        self.client.post(
+            '/container_group/redis',
+            headers=headers, data=json.dumps({
+                "specs": {"image": "redis"},
+                "slots": 3
+            }))
+
+        stopped = self._get_container_response('containerid_1', 'exited')
+        stopped[u'Labels'] = {u'dockercontainerpool.group': u'redis',
+                              u'dockercontainerpool.slot': u'1'}
+        self.docker_client_mock.containers.return_value = [stopped]
+        self.docker_client_mock.create_container.side_effect = [
+            dict(Id='containerid_0'), dict(Id='containerid_2'),
+            dict(Id='containerid_3')]
+
+        result = self.client.post(
+            '/container_group/redis/set_running_container',
+            headers=headers, data=json.dumps(dict(count=2)))
+        self.assertEqual(200, result.status_code)
+        self.assertEqual(
+            'redis--0',
+            self.docker_client_mock.create_container.call_args[1]['name'])
+        # stopped containers are started before new ones are created
+        self.assertEqual(
+            [call(u'containerid_1'), call('containerid_0')],
+            self.docker_client_mock.start.call_args_list)
+
+        result = self.client.post(
+            '/container_group/redis/set_running_container',
+            headers=headers, data=json.dumps(dict(count=3)))
+        self.assertEqual(
+            'redis--2',
+            self.docker_client_mock.create_container.call_args[1]['name'])
+        # containers which are not acquired are stopped first
+        self.pool.get_container_group('redis').leased.add('containerid_2')
+        result = self.client.post(
+            '/container_group/redis/set_running_container',
+            headers=headers, data=json.dumps(dict(count=1)))
+        self.assertEqual(
+            [call(u'containerid_1'), call('containerid_0')],
+            self.docker_client_mock.stop.call_args_list)
+
+        result = self.client.post(
+            '/container_group/redis/set_running_container',
+            headers=headers, data=json.dumps(dict(count=4)))
+        self.assertEqual(500, result.status_code)
+        self.assertEqual("DockerContainerGroupException", json.loads(
+            result.data).get("error_type"))
+
+        # the slots are loaded once, the scaling needs no listing
+        self.assertEqual(1, self.docker_client_mock.containers.call_count)
+
+        result = self.client.get('/container_group/redis/slot/1')
+        self.assertEqual('containerid_1', json.loads(result.data)['Id'])
+        self.assertEqual('exited', json.loads(result.data)['State'])
+
+        for result in [
+                self.client.get('/container_group/redis/slot/3'),
+                self.client.post('/container_group/redis/slot/3/replace'),
+                self.client.post(
+                    '/container_group/redis/container',
+                    headers=headers, data=json.dumps({"slot": -1}))]:
+            self.assertEqual(404, result.status_code)
+            self.assertEqual("DockerContainerGroupSlotNotFound", json.loads(
+                result.data).get("error_type"))
+
+        result = self.client.post('/container_group/redis/slot/1/replace')
+        self.assertEqual(200, result.status_code)
+        self.assertEqual('containerid_3', json.loads(result.data)['Id'])
+        self.assertEqual('running', json.loads(result.data)['State'])
+        self.assertEqual(
+            'redis--1',
+            self.docker_client_mock.create_container.call_args[1]['name'])
+        self.assertIn(
+            call(u'containerid_1', force=True),
+            self.docker_client_mock.remove_container.call_args_list)
+
+        # all slots are taken
+        result = self.client.post(
+            '/container_group/redis/container',
+            headers=headers, data=json.dumps({"start": False}))
+        self.assertEqual(500, result.status_code)
+        self.assertEqual("DockerContainerGroupException", json.loads(
+            result.data).get("error_type"))
+
+    def test_slots_failed_start(self):
+        headers = {"Content-Type": "application/json"}
+        self.client.post(
+            '/container_group/redis',
+            headers=headers, data=json.dumps({
+                "specs": {"image": "redis"},
+                "slots": 2
+            }))
+        container_group = self.pool.get_container_group('redis')
+        self.docker_client_mock.containers.return_value = []
+        self.docker_client_mock.create_container.side_effect = [
+            dict(Id='containerid_0'), dict(Id='containerid_1'),
+            dict(Id='containerid_2')]
+        self.docker_client_mock.start.side_effect = APIError(
+            Mock(), Mock(), "explanation")
+
+        # the container is removed, its name is free again
+        result = self.client.post(
+            '/container_group/redis/container',
+            headers=headers, data=json.dumps({"start": True}))
+        self.assertEqual(500, result.status_code)
+        self.assertEqual(
+            call('containerid_0', force=True),
+            self.docker_client_mock.remove_container.call_args)
+        self.assertEqual([None, None], container_group.slot_list)
+
+        # a container which cannot be removed keeps its slot
+        self.docker_client_mock.remove_container.side_effect = APIError(
+            Mock(), Mock(), "explanation")
+        result = self.client.post(
+            '/container_group/redis/container',
+            headers=headers, data=json.dumps({"start": True}))
+        self.assertEqual(500, result.status_code)
+        self.assertEqual(
+            ('containerid_1', 'created'),
+            (container_group.slot_list[0]['Id'],
+             container_group.slot_list[0]['State']))
+
+        self.docker_client_mock.start.side_effect = None
+        result = self.client.post(
+            '/container_group/redis/container',
+            headers=headers, data=json.dumps({"start": True}))
+        self.assertEqual(200, result.status_code)
+        self.assertEqual(
+            'redis--1',
+            self.docker_client_mock.create_container.call_args[1]['name'])
+
+    def test_container_not_in_group(self):
+        self._set_container_group()
+        self._set_container_group('redis--cache')
+
+        container = self._get_container_response('containerid_1', 'running')
+        container[u'Labels'] = {u'dockercontainerpool.group': u'redis--cache'}
+        self.docker_client_mock.containers.return_value = [container]
+
+        result = self.client.post(
+            '/container_group/redis/container/containerid_1/stop')
+        self.assertEqual(404, result.status_code)
+        self.assertEqual("DockerContainerGroupContainerNotFound", json.loads(
+            result.data).get("error_type"))
+        self.assertFalse(self.docker_client_mock.stop.called)
+
+        # a short id, found in the index without another listing
+        result = self.client.post(
+            '/container_group/redis--cache/container/containerid/stop')
+        self.assertEqual(200, result.status_code)
+        result = self.client.post(
+            '/container_group/redis--cache/container/containerid/stop')
+        self.assertEqual(4, self.docker_client_mock.containers.call_count)
+
+    def test_delete_container_group_legacy_container(self):
+        self._set_container_group()
+
+        legacy = self._get_container_response('containerid_1', 'exited')
+        legacy[u'Labels'] = {}
+        legacy[u'Names'] = [u'/redis--0f3b5f2e-6f7a-4b53-9b1e-2d1c3a4b5c6d']
+        other = self._get_container_response('containerid_2', 'exited')
+        other[u'Labels'] = {}
+        other[u'Names'] = [
+            u'/redis--cache--0f3b5f2e-6f7a-4b53-9b1e-2d1c3a4b5c6d']
+        self.docker_client_mock.containers.side_effect = [
+            [], [legacy, other]]
+
+        result = self.client.delete('/container_group/redis')
+        self.assertEqual(200, result.status_code)
+        self.assertEqual(
+            [call(u'containerid_1', force=True)],
+            self.docker_client_mock.remove_container.call_args_list)
+
     def test_start_container(self):
         self._set_container_group()
 
@@ -186,6 +718,7 @@ class DockerContainerPoolTestCase(unittest.TestCase):
 
         container_id = 'meinecontainerid'
         mycontainer = self._get_container_response(container_id, 'running')
+        self.docker_client_mock.containers.return_value = [mycontainer]
 
         answer = "total 4\n-rw-r--r-- 1 redis redis 18 May 10 13:08 dump.rdb\n"
 
@@ -205,11 +738,99 @@ class DockerContainerPoolTestCase(unittest.TestCase):
             call(exec_id=u'exec_id'),
             self.docker_client_mock.exec_start.call_args)
 
+    def _exec_socket(self, output=None):
+        # the socket of exec_start, a command without output hangs
+        sock, peer = socket.socketpair()
+        self.addCleanup(peer.close)
+        if output is not None:
+            peer.sendall(struct.pack('>BxxxL', 1, len(output)) + output)
+            peer.close()
+        return sock
+
+    def test_exec_command_group(self):
+        self._set_container_group()
+
+        self.docker_client_mock.containers.return_value = [
+            self._get_container_response('containerid_1', 'running'),
+            self._get_container_response('containerid_2', 'running'),
+        ]
+        self.docker_client_mock.exec_create.side_effect = \
+            lambda container, cmd: 'exec_' + container
+        self.docker_client_mock.exec_start.side_effect = \
+            lambda exec_id, socket: self._exec_socket('OK')
+        self.docker_client_mock.exec_inspect.return_value = dict(ExitCode=0)
+
+        headers = {"Content-Type": "application/json"}
+        result = self.client.post(
+            '/container_group/redis/exec',
+            headers=headers, data=json.dumps(dict(
+                command='redis-cli flushall', workers=2)))
+        self.assertEqual(200, result.status_code)
+        results = [json.loads(line) for line in result.data.splitlines()]
+        self.assertEqual(
+            [dict(Id='containerid_1', output='OK', exit_code=0),
+             dict(Id='containerid_2', output='OK', exit_code=0)],
+            sorted(results, key=lambda r: r['Id']))
+
+    def test_exec_command_group_listing_failed(self):
+        self._set_container_group()
+
+        # reported as error response, not in the middle of the stream
+        self.docker_client_mock.containers.side_effect = APIError(
+            Mock(), Mock(status_code=500, reason='Server Error'),
+            "explanation")
+        headers = {"Content-Type": "application/json"}
+        result = self.client.post(
+            '/container_group/redis/exec',
+            headers=headers, data=json.dumps(dict(command='ls')))
+        self.assertEqual(500, result.status_code)
+
+    def test_exec_command_group_timeout(self):
+        self._set_container_group()
+        container_group = self.pool.get_container_group('redis')
+
+        self.docker_client_mock.exec_create.side_effect = \
+            lambda container, cmd: container
+        self.docker_client_mock.exec_start.side_effect = \
+            lambda exec_id, socket: self._exec_socket(
+                None if exec_id == 'slow' else 'OK')
+        self.docker_client_mock.exec_inspect.return_value = dict(ExitCode=0)
+
+        threads = threading.active_count()
+        results = list(container_group.exec_command_group(
+            'ls', ['slow', 'fast_1', 'fast_2'], workers=1, timeout=0.2))
+        self.assertEqual(dict(Id='slow', error='timeout'), results[0])
+        self.assertEqual(
+            ['fast_1', 'fast_2'], sorted(r['Id'] for r in results[1:]))
+        # the slow command does not keep a worker
+        self.assertEqual(threads, threading.active_count())
+
+    def test_exec_command_group_error(self):
+        self._set_container_group()
+        container_group = self.pool.get_container_group('redis')
+
+        self.docker_client_mock.exec_create.side_effect = \
+            lambda container, cmd: container
+        self.docker_client_mock.exec_start.side_effect = \
+            lambda exec_id, socket: self._exec_socket('OK')
+        self.docker_client_mock.exec_inspect.side_effect = \
+            lambda exec_id: dict(ExitCode=0) if exec_id == 'fine' \
+            else {}['ExitCode']
+
+        results = list(container_group.exec_command_group(
+            'ls', ['broken', 'fine'], workers=1))
+        self.assertEqual(
+            [dict(Id='broken', error="'ExitCode'"),
+             dict(Id='fine', output='OK', exit_code=0)],
+            sorted(results, key=lambda r: r['Id']))
+
     def test_remove_container(self):
         self._set_container_group()
 
         self.docker_client_mock.kill.side_effect = APIError(
             Mock(), Mock(), "explanation")
+        self.docker_client_mock.containers.return_value = [
+            self._get_container_response('meinecontainerid', 'running')]
 
         container_id = 'meinecontainerid'
         headers = {"Content-Type": "application/json"}
@@ -227,6 +848,135 @@ class DockerContainerPoolTestCase(unittest.TestCase):
             call(u'meinecontainerid'),
             self.docker_client_mock.remove_container.call_args)
 
+    def test_delete_container_group(self):
+        self._set_container_group()
+
+        container_list = [
+            self._get_container_response('containerid_1', state='running'),
+            self._get_container_response('containerid_2', state='exited'),
+        ]
+        self.docker_client_mock.containers.return_value = container_list
+
+        headers = {"Content-Type": "application/json"}
+        result = self.client.delete(
+            '/container_group/redis',
+            headers=headers, data=json.dumps(dict(workers=2, timeout=5)))
+        self.assertEqual(200, result.status_code)
+
+        self.assertEqual(
+            [call(u'containerid_1', timeout=5)],
+            self.docker_client_mock.stop.call_args_list)
+        self.assertEqual(
+            sorted([call(u'containerid_1', force=True),
+                    call(u'containerid_2', force=True)]),
+            sorted(self.docker_client_mock.remove_container.call_args_list))
+        self.assertFalse(self.docker_client_mock.kill.called)
+
+        result = self.client.get('/container_group/redis')
+        self.assertEqual(404, result.status_code)
+
+    def test_remove_container_list_concurrent(self):
+        self._set_container_group()
+        container_group = self.pool.get_container_group('redis')
+
+        container_list = []
+        for i in range(300):
+            container = self._get_container_response(
+                'containerid_{}'.format(i), 'running')
+            container[u'Labels'] = {
+                u'dockercontainerpool.group': u'redis',
+                u'dockercontainerpool.operation': u'op{}'.format(i)}
+            container_list.append(container)
+            container_group.affinity['user-{}'.format(i)] = [
+                container, time.time() + 60]
+        self.docker_client_mock.containers.return_value = container_list
+        container_group.get_container_list()
+        # the call count of a mock is not thread safe
+        removed = []
+        self.docker_client_mock.remove_container.side_effect = \
+            lambda container_id, force: removed.append(container_id)
+
+        # the workers unindex the containers at the same time
+        container_group.remove_container_list(container_list, workers=20)
+        self.assertEqual(300, len(set(removed)))
+        self.assertEqual({}, container_group.label_index)
+        self.assertEqual({}, container_group.affinity)
+
+    def test_drain(self):
+        self._set_container_group()
+
+        container = self._get_container_response('containerid_1', 'running')
+        self.docker_client_mock.containers.return_value = [container]
+
+        self.pool.drain(timeout=5)
+        self.assertEqual(
+            dict(state='drained', total=1, done=1), self.pool.drain_progress)
+        self.assertEqual(
+            call(u'containerid_1', force=True),
+            self.docker_client_mock.remove_container.call_args)
+
+        result = self._set_container_group('other')
+        self.assertEqual(503, result.status_code)
+        self.assertEqual("DockerContainerPoolDraining", json.loads(
+            result.data).get("error_type"))
+
+        headers = {"Content-Type": "application/json"}
+        result = self.client.post(
+            '/container_group/redis/container',
+            headers=headers, data=json.dumps({"start": True}))
+        self.assertEqual(503, result.status_code)
+
+        result = self.client.delete('/drain')
+        self.assertEqual(200, result.status_code)
+        result = self._set_container_group('other')
+        self.assertEqual(200, result.status_code)
+
+    def test_drain_in_background(self):
+        self._set_container_group()
+
+        container = self._get_container_response('containerid_1', 'running')
+        self.docker_client_mock.containers.return_value = [container]
+        stopping = threading.Event()
+        self.docker_client_mock.stop.side_effect = \
+            lambda container_id, timeout: stopping.wait(5)
+
+        headers = {"Content-Type": "application/json"}
+        result = self.client.post(
+            '/drain', headers=headers, data=json.dumps(dict(
+                timeout=5, unknown=True)))
+        self.assertEqual(202, result.status_code)
+
+        # neither a second drain nor a resume while draining
+        result = self.client.post('/drain')
+        self.assertEqual(503, result.status_code)
+        result = self.client.delete('/drain')
+        self.assertEqual(503, result.status_code)
+
+        stopping.set()
+        for _ in range(50):
+            if self.pool.drain_progress['state'] != 'draining':
+                break
+            time.sleep(0.1)
+        self.assertEqual(
+            dict(state='drained', total=1, done=1),
+            json.loads(self.client.get('/drain').data))
+
+    def test_drain_failed(self):
+        self._set_container_group()
+
+        container = self._get_container_response('containerid_1', 'running')
+        self.docker_client_mock.containers.return_value = [container]
+        self.docker_client_mock.stop.side_effect = IOError('read timeout')
+
+        self.pool.drain()
+        self.assertEqual(
+            dict(state='failed', total=1, done=0, message='read timeout'),
+            self.pool.drain_progress)
+
+        # the drain can be ended and started again
+        result = self.client.delete('/drain')
+        self.assertEqual(200, result.status_code)
+
     def _set_container_group(
             self,
             group_identifier='redis',
@@ -247,7 +997,7 @@ class DockerContainerPoolTestCase(unittest.TestCase):
                 u'Status': state,
                 u'Created': 1462873363,
                 u'Image': u'redis',
-                u'Labels': {},
+                u'Labels': {u'dockercontainerpool.group': u'redis'},
                 u'NetworkSettings': {
                     u'Networks': {
                         u'bridge': {
@@ -281,5 +1031,268 @@ class DockerContainerPoolTestCase(unittest.TestCase):
         }
 
 
+class DockerContainerPoolClientTestCase(unittest.TestCase):
+    @patch('dockercontainerpool.docker_container_pool.docker.Client')
+    def setUp(self, docker_client):
+        self.docker_client_mock = Mock()
+        docker_client.return_value = self.docker_client_mock
+
+        with app.app_context() as app_context:
+            current_app.pool = DockerContainerPool(
+                'unix://path/to/docker.sock')
+
+        self.test_client = app.test_client()
+        session = Mock()
+        session.request.side_effect = self._request
+        self.client = DockerContainerPoolClient(
+            'http://localhost:5000/', session=session)
+
+    def _request(self, method, url, data=None, headers=None):
+        # routes the requests of the client to the flask test client
+        result = self.test_client.open(
+            url.replace('http://localhost:5000', ''),
+            method=method, data=data, headers=headers)
+        return Mock(
+            status_code=result.status_code,
+            content=result.data,
+            reason=result.status)
+
+    def test_cache(self):
+        self.client.add_container_group('redis', dict(image='redis'))
+        self.docker_client_mock.containers.return_value = []
+
+        self.assertEqual([], self.client.get_container_list('redis'))
+        self.assertEqual([], self.client.get_container_list('redis'))
+        self.assertEqual(1, self.docker_client_mock.containers.call_count)
+
+        # changes of the group invalidate the cache
+        self.client.set_available_container('redis', 0)
+        self.assertEqual([], self.client.get_container_list('redis'))
+        self.assertEqual(3, self.docker_client_mock.containers.call_count)
+
+    def test_error(self):
+        with self.assertRaises(DockerContainerPoolClientException) as cm:
+            self.client.get_container_group('redis')
+        self.assertEqual(404, cm.exception.status_code)
+        self.assertEqual(
+            'DockerContainerPoolGroupNotFound', cm.exception.error_type)
+
+    def test_batch(self):
+        self.client.add_container_group('redis', dict(image='redis'))
+        self.docker_client_mock.exec_create.return_value = 'exec_id'
+        self.docker_client_mock.exec_start.return_value = 'PONG'
+        self.docker_client_mock.containers.return_value = [
+            dict(Id=container_id,
+                 Labels={'dockercontainerpool.group': 'redis'})
+            for container_id in ['containerid_1', 'containerid_2']]
+
+        result = self.client.batch([
+            ('exec_command_container', ('redis', 'containerid_1', 'ping')),
+            ('exec_command_container', ('redis', 'containerid_2', 'ping')),
+        ])
+        self.assertEqual(['PONG', 'PONG'], result)
+
+
+class DemandHistoryTestCase(unittest.TestCase):
+    def test_forecast(self):
+        demand = DemandHistory(bucket_seconds=3600, smoothing=1.0)
+        monday = 4 * 24 * 3600  # 1970-01-01 was a thursday
+
+        # demand of 10 at 8 o'clock and none else
+        demand.record('redis', 10, now=monday + 8 * 3600)
+        demand.record('redis', 0, now=monday + 9 * 3600)
+        self.assertEqual(0, demand.forecast('other', now=monday))
+
+        tuesday = monday + 24 * 3600
+        # the daily profile expects the peak, the weekly one does not
+        self.assertEqual(
+            5, demand.forecast('redis', lead=2, now=tuesday + 6 * 3600))
+        self.assertEqual(
+            0, demand.forecast('redis', lead=1, now=tuesday + 6 * 3600))
+
+        # a week without demand: only the weekly profile expects the peak
+        next_monday = monday + 7 * 24 * 3600
+        self.assertEqual(
+            5, demand.forecast('redis', lead=1, now=next_monday + 7 * 3600))
+
+    def test_save_load(self):
+        path = os.path.join(tempfile.mkdtemp(), 'demand.json')
+        demand = DemandHistory(path, bucket_seconds=3600, smoothing=0.5)
+        demand.record('redis', 4, now=3600)
+        demand.record('redis', 0, now=2 * 3600)
+        demand.save()
+
+        self.assertEqual(
+            demand.profiles,
+            DemandHistory(path, bucket_seconds=3600).profiles)
+        self.assertEqual(
+            {}, DemandHistory(path, bucket_seconds=300).profiles)
+
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'journal')
+
+    def test_read(self):
+        journal = Journal(self.path)
+        with journal.operation(
+                'add_container_group', 'redis',
+                args=[], kwargs=dict(specs=dict(image='redis'))):
+            pass
+        with journal.operation(
+                'update_container_group', 'redis',
+                specs=dict(image='redis:3')):
+            pass
+        with self.assertRaises(ValueError):
+            with journal.operation(
+                    'add_container_group', 'failed', args=[], kwargs={}):
+                raise ValueError()
+        with journal.operation(
+                'set_running_container', 'redis', count=3) as operation_id:
+            self.assertEqual(operation_id, journal.current_operation)
+            # crash
+            groups, pending = Journal(self.path).read()
+
+        self.assertEqual(
+            dict(redis=dict(args=[], kwargs=dict(
+                specs=dict(image='redis:3')))),
+            groups)
+        self.assertEqual(1, len(pending))
+        self.assertEqual('set_running_container', pending[0]['operation'])
+        self.assertEqual(dict(count=3), pending[0]['arguments'])
+
+    def test_compact(self):
+        journal = Journal(self.path)
+        for group_identifier in ['redis', 'other']:
+            with journal.operation(
+                    'add_container_group', group_identifier,
+                    args=[], kwargs=dict(specs=dict(image='redis'))):
+                pass
+        with journal.operation('delete_container_group', 'other'):
+            pass
+        groups, _ = journal.read()
+        journal.compact(groups)
+
+        with open(self.path) as f:
+            self.assertEqual(2, len(f.readlines()))
+        self.assertEqual((groups, []), Journal(self.path).read())
+
+    def test_compact_at_max_size(self):
+        journal = Journal(self.path, max_size=2048)
+        with journal.operation(
+                'add_container_group', 'redis',
+                args=[], kwargs=dict(specs=dict(image='redis'))):
+            pass
+        with journal.operation(
+                'set_running_container', 'redis', count=3) as operation_id:
+            for _ in range(100):
+                with journal.operation('acquire_container', 'redis', count=1):
+                    pass
+            self.assertLess(os.path.getsize(self.path), 2048)
+            # a pending operation survives the compaction
+            _, pending = Journal(self.path).read()
+            self.assertEqual([operation_id], [o['id'] for o in pending])
+
+        groups, pending = Journal(self.path).read()
+        self.assertEqual(['redis'], list(groups))
+        self.assertEqual([], pending)
+
+    @patch('dockercontainerpool.docker_container_pool.docker.Client')
+    def test_recover_failed_replay(self, docker_client):
+        docker_client_mock = Mock()
+        docker_client.return_value = docker_client_mock
+
+        journal = Journal(self.path)
+        with journal.operation(
+                'add_container_group', 'redis',
+                args=[], kwargs=dict(specs=dict(image='redis'), slots=2)):
+            pass
+        with journal.operation('set_running_container', 'redis', count=3):
+            # crash
+            journal.close()
+
+        # the orphan listing fails, the replay raises for 3 of 2 slots
+        docker_client_mock.containers.side_effect = [
+            APIError(Mock(), Mock(), "explanation"), []]
+        pool = DockerContainerPool(
+            'unix://path/to/docker.sock', journal=self.path)
+        pool.journal.compact = Mock()
+        pool.recover()
+
+        self.assertEqual(['redis'], list(pool.container_group_list))
+        self.assertTrue(pool.journal.compact.called)
+        # even without the compaction, the replay is not tried again
+        groups, pending = Journal(self.path).read()
+        self.assertEqual(['redis'], list(groups))
+        self.assertEqual([], pending)
+
+    @patch('dockercontainerpool.docker_container_pool.docker.Client')
+    def test_recover(self, docker_client):
+        docker_client_mock = Mock()
+        docker_client.return_value = docker_client_mock
+
+        journal = Journal(self.path)
+        with journal.operation(
+                'add_container_group', 'redis',
+                args=[], kwargs=dict(specs=dict(image='redis'))):
+            pass
+        # two threads, each one in the middle of an operation
+        other_journal = Journal(self.path)
+        with journal.operation(
+                'set_running_container', 'redis', count=1) as running_id:
+            with journal.operation(
+                    'create_container', 'redis', start=True, specs={}):
+                # containers are labeled with the outermost operation
+                self.assertEqual(running_id, journal.current_operation)
+                with other_journal.operation(
+                        'acquire_container', 'redis',
+                        count=1, session_key=None) as acquire_id:
+                    with other_journal.operation(
+                            'create_container', 'redis',
+                            start=True, specs={}):
+                        # crash
+                        other_journal.close()
+                        journal.close()
+
+        def container(container_id, group_identifier, operation=None):
+            labels = {'dockercontainerpool.group': group_identifier}
+            if operation:
+                labels['dockercontainerpool.operation'] = operation
+            return dict(Id=container_id, State='created', Labels=labels)
+
+        docker_client_mock.containers.side_effect = [
+            [container('containerid_1', 'redis'),
+             container('containerid_2', 'redis', running_id),
+             container('containerid_3', 'redis', acquire_id),
+             container('containerid_4', 'gone'),
+             dict(container('containerid_5', 'redis', running_id),
+                  Labels={'dockercontainerpool.group': 'redis',
+                          'dockercontainerpool.state': 'snapshot'})],
+            [dict(Id='containerid_1', State='running')],
+        ]
+
+        pool = DockerContainerPool(
+            'unix://path/to/docker.sock', journal=self.path)
+        pool.recover()
+
+        self.assertEqual(['redis'], list(pool.container_group_list))
+        self.assertEqual(
+            call(all=True, filters={'label': 'dockercontainerpool.group'}),
+            docker_client_mock.containers.call_args_list[0])
+        # the interrupted acquire is rolled back, the containers of
+        # set_running_container are kept for its replay
+        self.assertEqual(
+            sorted([call('containerid_3', force=True),
+                    call('containerid_4', force=True),
+                    call('containerid_5', force=True)]),
+            sorted(docker_client_mock.remove_container.call_args_list))
+        # set_running_container(1) is run again
+        self.assertEqual(2, docker_client_mock.containers.call_count)
+
+        groups, pending = Journal(self.path).read()
+        self.assertEqual(['redis'], list(groups))
+        self.assertEqual([], pending)
+
+
 if __name__ == '__main__':
     unittest.main()